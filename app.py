@@ -1,8 +1,10 @@
 import os
+import tracemalloc
 from pathlib import Path
-from flask import Flask, flash, request, session, url_for, redirect, render_template, send_from_directory, abort
+from flask import Flask, Response, flash, request, session, url_for, redirect, render_template, send_from_directory, abort
 from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
+from utils import metrics
 from utils.file_utils import UPLOAD_FOLDER
 from views.hamtfrekvens_mat_rest import bp as hamtfrekvens_mat_rest_bp
 from views.hamtfrekvens_prisdel import bp as hamtfrekvens_prisdel_bp
@@ -10,12 +12,25 @@ from views.antalsvarde_individer import bp as antalsvarde_individer_bp
 from views.debiteringsgrupp_check import bp as debiteringsgrupp_check_bp
 from views.slamanlaggningar_check import bp as slamanlaggningar_check_bp
 from views.dorrtillagg_check import bp as dorrtillagg_check_bp
+from views.avtal_tjanst_check import bp as avtal_tjanst_check_bp
+from views.lookup import bp as lookup_bp
 
 load_dotenv(".env")
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'dev-secret'
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10 MB
+# Profilering av uppladdningar, se utils/profiling.py
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+app.config['PROFILE_ALL_UPLOADS'] = os.environ.get('PROFILE_ALL_UPLOADS') == '1'
+# Uppslagning i lagrade exporter, avstängd utan token, se views/lookup.py
+app.config['LOOKUP_TOKEN'] = os.environ.get('LOOKUP_TOKEN')
+# Minnesbudget per jobb i MB (avstängd om den inte är satt), se utils/memory.py
+app.config['MEMORY_BUDGET_MB'] = float(os.environ.get('MEMORY_BUDGET_MB') or 0) or None
+
+# tracemalloc ger exakt toppminne per steg men kostar prestanda, därför opt-in
+if os.environ.get('MEMORY_TRACEMALLOC') == '1':
+    tracemalloc.start()
 
 app.register_blueprint(hamtfrekvens_mat_rest_bp)
 app.register_blueprint(hamtfrekvens_prisdel_bp)
@@ -23,12 +38,15 @@ app.register_blueprint(antalsvarde_individer_bp)
 app.register_blueprint(debiteringsgrupp_check_bp)
 app.register_blueprint(slamanlaggningar_check_bp)
 app.register_blueprint(dorrtillagg_check_bp)
+app.register_blueprint(avtal_tjanst_check_bp)
+app.register_blueprint(lookup_bp)
 
 
 # Endpoint för startsidan
 @app.route('/', methods=['GET'])
 def index():
-    return render_template('index.html')
+    # Profileringstoken i adressen skickas vidare med uppladdningsformulären
+    return render_template('index.html', profile=request.args.get('profile'))
 
 
 # Endpoint för success-sida
@@ -51,7 +69,8 @@ def success():
         deviations=result.get('deviations', 0),
         output_filename=result.get('output_filename'),
         back_endpoint=result.get('back', 'index'),
-        message=result.get('message', 'Resultat')
+        message=result.get('message', 'Resultat'),
+        profile_filename=result.get('profile_filename')
     )
 
 
@@ -70,6 +89,12 @@ def download_file(filename):
     return send_from_directory(str(upload_resolved), filename, as_attachment=True)
 
 
+# Endpoint för mätvärden i Prometheus-format, summerat över alla uWSGI-processer
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # Felhantering för för stora filer
 @app.errorhandler(RequestEntityTooLarge)
 def handle_large_file(e):
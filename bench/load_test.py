@@ -0,0 +1,236 @@
+"""
+Lasttest av flödet uppladdning -> /success -> /download mot en lokalt startad server.
+
+Varje simulerad användare har en egen session (resultatet ligger i sessionskakan)
+och kör flödet om och om igen tills tiden är ute. Rapporten visar genomströmning,
+p50/p95/p99-latens per steg och andelen fel per feltyp.
+
+Exempel:
+    uwsgi --ini app.ini --http-socket :5000 --processes 5 --threads 2 &
+    python -m bench.load_test --url http://127.0.0.1:5000 --users 10 --duration 60
+
+    # Starta och stoppa servern från lasttestet
+    python -m bench.load_test --server-cmd "uwsgi --ini app.ini --http-socket :5000" --users 20
+"""
+import argparse
+import json
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import requests
+
+from bench.synthetic import CHECKS, generate, write_export
+
+# Kontrollnamn -> uppladdningsendpoint
+UPLOAD_PATHS: Dict[str, str] = {
+    "dorrtillagg": "/upload/dorrtillagg_check",
+    "hamtfrekvens": "/upload/hamtfrekvens",
+    "karl": "/upload/individer_check",
+    "debiteringsgrupp": "/upload/debiteringsgrupp_check",
+    "prisdel": "/upload/prisdel_check",
+    "slamanlaggningar": "/upload/slamanlaggningar_check",
+}
+
+STEPS = ("upload", "success", "download", "total")
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_DOWNLOAD_RE = re.compile(r'action="(/download/[^"]+)"')
+
+
+class FlowError(Exception):
+    # Felkategori som räknas i rapporten
+    pass
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {step: [] for step in STEPS}
+        self.errors: Counter = Counter()
+        self.flows = 0
+
+    def record(self, timings: Dict[str, float]) -> None:
+        with self._lock:
+            self.flows += 1
+            for step, value in timings.items():
+                self.latencies[step].append(value)
+
+    def error(self, kind: str) -> None:
+        with self._lock:
+            self.flows += 1
+            self.errors[kind] += 1
+
+
+def run_flow(http: requests.Session, base_url: str, check: str, filename: str, payload: bytes,
+             timeout: float) -> Dict[str, float]:
+    # Ett helt flöde för en användare, tider i sekunder per steg
+    timings = {}
+    start = time.perf_counter()
+
+    resp = http.post(
+        base_url + UPLOAD_PATHS[check],
+        files={"file": (filename, payload, XLSX_MIME)},
+        allow_redirects=False,
+        timeout=timeout,
+    )
+    timings["upload"] = time.perf_counter() - start
+    location = resp.headers.get("Location", "")
+    if resp.status_code != 302:
+        raise FlowError(f"upload HTTP {resp.status_code}")
+    if "/success" not in location:
+        # Bearbetningsfel flashas och användaren skickas tillbaka till startsidan
+        raise FlowError("upload avvisad")
+
+    t = time.perf_counter()
+    resp = http.get(requests.compat.urljoin(base_url, location), allow_redirects=False, timeout=timeout)
+    timings["success"] = time.perf_counter() - t
+    if resp.status_code != 200:
+        raise FlowError("success saknar resultat" if resp.status_code == 302 else f"success HTTP {resp.status_code}")
+    match = _DOWNLOAD_RE.search(resp.text)
+    if not match:
+        raise FlowError("success saknar nedladdningslänk")
+
+    t = time.perf_counter()
+    resp = http.get(base_url + match.group(1), timeout=timeout)
+    timings["download"] = time.perf_counter() - t
+    if resp.status_code != 200:
+        raise FlowError(f"download HTTP {resp.status_code}")
+
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def user_loop(user: int, args, payloads: Dict[str, bytes], stats: Stats, deadline: float) -> None:
+    checks = list(payloads)
+    http = requests.Session()
+    i = user
+    while time.perf_counter() < deadline:
+        if args.iterations and i - user >= args.iterations * len(checks):
+            break
+        # Användarna roterar mellan kontrollerna, förskjutet så att alla endpoints belastas samtidigt
+        check = checks[i % len(checks)]
+        i += 1
+        try:
+            stats.record(run_flow(http, args.url, check, f"{check}.xlsx", payloads[check], args.timeout))
+        except FlowError as e:
+            stats.error(str(e))
+        except requests.RequestException as e:
+            stats.error(type(e).__name__)
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def report(stats: Stats, elapsed: float, args) -> dict:
+    ok = len(stats.latencies["total"])
+    errors = sum(stats.errors.values())
+    return {
+        "users": args.users,
+        "rows": args.rows,
+        "checks": args.checks,
+        "elapsed_s": elapsed,
+        "flows": stats.flows,
+        "ok": ok,
+        "errors": dict(stats.errors),
+        "error_rate": errors / stats.flows if stats.flows else 0.0,
+        "throughput_per_s": ok / elapsed if elapsed > 0 else 0.0,
+        "latency_s": {step: percentiles(stats.latencies[step]) for step in STEPS},
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"\n{result['flows']} flöden på {result['elapsed_s']:.1f}s med {result['users']} användare")
+    print(f"Genomströmning: {result['throughput_per_s']:.2f} lyckade flöden/s")
+    print(f"Felfrekvens: {result['error_rate']:.1%}")
+    for kind, count in sorted(result["errors"].items(), key=lambda kv: -kv[1]):
+        print(f"  {count:>6}  {kind}")
+
+    def ms(v):
+        return "-" if v is None else f"{v * 1000:.0f} ms"
+
+    print(f"\n{'steg':<10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for step, p in result["latency_s"].items():
+        print(f"{step:<10}{ms(p['p50']):>10}{ms(p['p95']):>10}{ms(p['p99']):>10}")
+
+
+def wait_for_server(url: str, timeout: float) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            requests.get(url + "/", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Servern svarar inte på {url}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Lasttest av uppladdnings- och nedladdningsflödet")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--users", type=int, default=5, help="Antal samtidiga användare")
+    parser.add_argument("--duration", type=float, default=30, help="Testets längd i sekunder")
+    parser.add_argument("--iterations", type=int, default=0, help="Max flöden per användare och kontroll, 0 = obegränsat")
+    parser.add_argument("--checks", default=",".join(CHECKS), help="Kommaseparerade kontroller")
+    parser.add_argument("--rows", type=int, default=5000, help="Rader i den syntetiska exporten")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--server-cmd", help="Kommando som startar servern, stoppas efter testet")
+    parser.add_argument("--output", type=Path, help="JSON-fil för rapporten")
+    args = parser.parse_args(argv)
+    args.url = args.url.rstrip("/")
+
+    checks = [c.strip() for c in args.checks.split(",") if c.strip()]
+    unknown = set(checks) - set(UPLOAD_PATHS)
+    if unknown:
+        parser.error(f"Okända kontroller: {', '.join(sorted(unknown))}")
+
+    # Filerna skapas en gång och skickas från minnet
+    payloads = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for check in checks:
+            path = Path(tmp) / f"{check}.xlsx"
+            write_export(generate(check, args.rows), path)
+            payloads[check] = path.read_bytes()
+
+    server = subprocess.Popen(shlex.split(args.server_cmd)) if args.server_cmd else None
+    try:
+        wait_for_server(args.url, timeout=30)
+
+        stats = Stats()
+        start = time.perf_counter()
+        deadline = start + args.duration
+        threads = [
+            threading.Thread(target=user_loop, args=(user, args, payloads, stats, deadline), daemon=True)
+            for user in range(args.users)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+    result = report(stats, elapsed, args)
+    print_report(result)
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Mäter inläsning, kontroll och skrivning var för sig för de sex kontrollerna
+på syntetiska exporter av ökande storlek.
+
+Exempel:
+    python -m bench.run_benchmarks --sizes 1000,10000,100000 --output bench/results/ny.json
+    python -m bench.run_benchmarks --baseline bench/results/baslinje.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+from bench.synthetic import CHECKS, FORMATS, check_function, check_module, generate, read_raw, write_export
+from utils import dataset_cache
+from utils.export_utils import prepare_export, read_export, write_deviations
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+STAGES = ("parse", "check", "write")
+
+# Tider under detta golv (sekunder) är för brusiga för att jämföras mot baslinjen
+NOISE_FLOOR = 0.005
+
+
+def load_export(path: Path, required: set) -> pd.DataFrame:
+    # Samma inläsningssteg som i process_*, xlsx går via read_export (utan den delade cachen, se main)
+    if path.suffix == ".xlsx":
+        return read_export(path, required)
+    return prepare_export(read_raw(path), required)
+
+
+def dataset(data_dir: Path, check: str, rows: int, fmt: str, group_size: float, rate: float, seed: int) -> Path:
+    # Syntetiska filer återanvänds mellan körningar, de stora tar lång tid att skriva
+    path = data_dir / f"{check}_{rows}_g{group_size:g}_d{rate:g}_s{seed}.{fmt}"
+    if not path.exists():
+        data_dir.mkdir(parents=True, exist_ok=True)
+        write_export(generate(check, rows, group_size, rate, seed), path)
+    return path
+
+
+def run_one(path: Path, check: str, repeat: int, out_dir: Path) -> Dict[str, object]:
+    required = check_module(check).RULES.required
+    check_fn = check_function(check)
+    times: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    deviations = 0
+
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        df = load_export(path, required)
+        t1 = time.perf_counter()
+        out_df = check_fn(df)
+        t2 = time.perf_counter()
+        write_deviations(out_df, out_dir / f"avvikelser_{check}.xlsx")
+        t3 = time.perf_counter()
+
+        times["parse"].append(t1 - t0)
+        times["check"].append(t2 - t1)
+        times["write"].append(t3 - t2)
+        deviations = len(out_df)
+
+    result: Dict[str, object] = {"deviations": deviations}
+    for stage, values in times.items():
+        result[f"{stage}_min"] = min(values)
+        result[f"{stage}_median"] = statistics.median(values)
+    return result
+
+
+def metadata(args) -> Dict[str, object]:
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "format": args.format,
+        "group_size": args.group_size,
+        "deviation_rate": args.deviation_rate,
+        "seed": args.seed,
+        "repeat": args.repeat,
+    }
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """
+    Jämför min-tiderna per steg mot baslinjen och returnerar de mätningar som
+    blivit mer än tolerance långsammare.
+    """
+    base = {(r["check"], r["rows"], r["format"]): r for r in baseline}
+    regressions = []
+    print(f"\n{'kontroll':<18}{'rader':>9}  " + "  ".join(f"{s:>8}" for s in STAGES))
+    for r in results:
+        b = base.get((r["check"], r["rows"], r["format"]))
+        if b is None:
+            continue
+        ratios = []
+        for stage in STAGES:
+            new, old = r[f"{stage}_min"], b[f"{stage}_min"]
+            ratio = new / old if old > 0 else float("inf")
+            ratios.append(f"{ratio:>7.2f}x")
+            if max(new, old) >= NOISE_FLOOR and ratio > 1 + tolerance:
+                regressions.append(f"{r['check']} {r['rows']} rader, {stage}: {old:.3f}s -> {new:.3f}s")
+        if r["deviations"] != b["deviations"]:
+            regressions.append(f"{r['check']} {r['rows']} rader: {b['deviations']} -> {r['deviations']} avvikelser")
+        print(f"{r['check']:<18}{r['rows']:>9}  " + "  ".join(ratios))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Prestandamätning av kontrollerna på syntetiska data")
+    parser.add_argument("--checks", default=",".join(CHECKS), help="Kommaseparerade kontroller")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Kommaseparerade radantal")
+    parser.add_argument("--format", choices=FORMATS, default="xlsx")
+    parser.add_argument("--group-size", type=float, default=3)
+    parser.add_argument("--deviation-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", type=Path, default=Path(tempfile.gettempdir()) / "bench_data")
+    parser.add_argument("--output", type=Path, help="JSON-fil för resultaten")
+    parser.add_argument("--baseline", type=Path, help="Tidigare JSON-resultat att jämföra mot")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Tillåten försämring, 0.2 = 20 %%")
+    args = parser.parse_args(argv)
+
+    checks = [c.strip() for c in args.checks.split(",") if c.strip()]
+    unknown = set(checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"Okända kontroller: {', '.join(sorted(unknown))}")
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    # Varje upprepning ska tolka filen, inte minnesmappa den från den delade cachen
+    # (utils/dataset_cache.py), annars mäter parse något annat än före cachen
+    dataset_cache.CACHE_MAX_FILES = 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for check in checks:
+            for rows in sizes:
+                path = dataset(args.data_dir, check, rows, args.format, args.group_size, args.deviation_rate, args.seed)
+                result = {"check": check, "rows": rows, "format": args.format}
+                result.update(run_one(path, check, args.repeat, Path(tmp)))
+                results.append(result)
+                print(f"{check:<18}{rows:>9} rader  "
+                      + "  ".join(f"{s} {result[f'{s}_min']:.3f}s" for s in STAGES)
+                      + f"  ({result['deviations']} avvikelser)", flush=True)
+
+    report = {"meta": metadata(args), "results": results}
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print("\nFörsämringar mot baslinjen:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nInga försämringar mot baslinjen.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Mäter kallstarten för en worker: uppstarten av appen i mastern och de första
+anropen i en forkad worker, med och utan uppvärmning (WARMUP, se utils/warmup.py).
+
+Varje mätning körs i en ny Python-process som importerar wsgi som uWSGI gör
+och sedan forkar en worker. Workern mäter första GET /, första uppladdningen,
+en andra uppladdning (varm worker) och hur mycket minne den fått kopiera
+(Private_Dirty, bara på Linux).
+
+Exempel:
+    python -m bench.startup --output bench/results/start.json
+    python -m bench.startup --baseline bench/results/start.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from bench.load_test import UPLOAD_PATHS
+from bench.synthetic import CHECKS, generate, write_export
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODES = {"kall": "0", "uppvärmd": "1"}
+METRICS = ("import", "warmup", "first_index", "first_upload", "second_upload")
+
+# Tider under detta golv (sekunder) är för brusiga för att jämföras mot baslinjen
+NOISE_FLOOR = 0.005
+
+
+def _private_dirty_mb() -> Optional[float]:
+    # Minne som workern skrivit i och därmed kopierat från mastern
+    try:
+        for line in Path("/proc/self/smaps_rollup").read_text().splitlines():
+            if line.startswith("Private_Dirty:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _worker(app, upload_path: str, files: List[Path]) -> Dict[str, object]:
+    # Som en nyforkad uWSGI-worker: de första anropen efter fork
+    client = app.test_client()
+    result: Dict[str, object] = {}
+
+    start = time.perf_counter()
+    client.get("/")
+    result["first_index"] = time.perf_counter() - start
+
+    for name, path in zip(("first_upload", "second_upload"), files):
+        # Ögonblicksbilden från förra uppladdningen tas bort så att båda kontrolleras fullt ut
+        shutil.rmtree(os.environ["STATE_DIR"], ignore_errors=True)
+        with open(path, "rb") as f:
+            start = time.perf_counter()
+            response = client.post(upload_path, data={"file": (f, path.name)}, content_type="multipart/form-data")
+            result[name] = time.perf_counter() - start
+        if response.status_code != 302 or "success" not in response.headers.get("Location", ""):
+            raise RuntimeError(f"Uppladdningen misslyckades: {response.status_code}")
+
+    result["private_dirty_mb"] = _private_dirty_mb()
+    return result
+
+
+def child(upload_path: str, files: List[Path]) -> None:
+    # Körs i en ny process: starta appen som uWSGI-mastern och mät i en forkad worker
+    start = time.perf_counter()
+    from app import app
+    imported = time.perf_counter()
+    importlib.import_module("wsgi")  # uppvärmning och gc.freeze
+    result: Dict[str, object] = {"import": imported - start, "warmup": time.perf_counter() - imported}
+
+    if not hasattr(os, "fork"):
+        result.update(_worker(app, upload_path, files))
+        print(json.dumps(result))
+        return
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            payload = json.dumps(_worker(app, upload_path, files))
+        except Exception as e:
+            payload, status = json.dumps({"error": repr(e)}), 1
+        with os.fdopen(write_fd, "w") as out:
+            out.write(payload)
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as inp:
+        worker = json.loads(inp.read())
+    os.waitpid(pid, 0)
+    if "error" in worker:
+        raise RuntimeError(worker["error"])
+    result.update(worker)
+    print(json.dumps(result))
+
+
+def run_one(mode: str, check: str, files: List[Path], work_dir: Path) -> Dict[str, object]:
+    env = dict(
+        os.environ,
+        PYTHONPATH=str(ROOT),
+        WARMUP=MODES[mode],
+        STATE_DIR=str(work_dir / "state"),
+        METRICS_DIR=str(work_dir / "metrics"),
+        DATASET_CACHE_MAX_FILES="0",
+        STORE_MAX_UPLOADS="0",
+    )
+    cmd = [sys.executable, "-m", "bench.startup", "--child", UPLOAD_PATHS[check], *map(str, files)]
+    proc = subprocess.run(cmd, cwd=work_dir, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "okänt fel")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs: List[Dict[str, object]]) -> Dict[str, object]:
+    result: Dict[str, object] = {}
+    for metric in METRICS:
+        values = [r[metric] for r in runs]
+        result[f"{metric}_min"] = min(values)
+        result[f"{metric}_median"] = statistics.median(values)
+    dirty = [r["private_dirty_mb"] for r in runs if r.get("private_dirty_mb") is not None]
+    result["private_dirty_mb"] = statistics.median(dirty) if dirty else None
+    return result
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    # Medianerna per läge mot baslinjen, mätningar som blivit mer än tolerance långsammare
+    regressions = []
+    for mode, r in results.items():
+        b = baseline.get(mode)
+        if b is None:
+            continue
+        for metric in METRICS:
+            new, old = r[f"{metric}_median"], b[f"{metric}_median"]
+            if max(new, old) >= NOISE_FLOOR and old > 0 and new / old > 1 + tolerance:
+                regressions.append(f"{mode}, {metric}: {old:.3f}s -> {new:.3f}s")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Kallstart för en worker, med och utan uppvärmning")
+    parser.add_argument("--check", choices=list(CHECKS), default="karl", help="Kontrollen som laddas upp")
+    parser.add_argument("--rows", type=int, default=1000, help="Rader i den syntetiska exporten")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="JSON-fil för resultaten")
+    parser.add_argument("--baseline", type=Path, help="Tidigare JSON-resultat att jämföra mot")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Tillåten försämring, 0.2 = 20 %%")
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.child[0], [Path(p) for p in args.child[1:]])
+        return 0
+
+    results: Dict[str, dict] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        files = [tmp_dir / f"{args.check}_{seed}.xlsx" for seed in (0, 1)]
+        for seed, path in enumerate(files):
+            write_export(generate(args.check, args.rows, seed=seed), path)
+
+        print(f"{'läge':<10}" + "".join(f"{m:>15}" for m in METRICS) + f"{'kopierat':>12}")
+        for mode in MODES:
+            runs = []
+            for i in range(args.repeat):
+                work_dir = tmp_dir / f"{mode}_{i}"
+                work_dir.mkdir()
+                runs.append(run_one(mode, args.check, files, work_dir))
+            results[mode] = summarize(runs)
+            dirty = results[mode]["private_dirty_mb"]
+            print(f"{mode:<10}" + "".join(f"{results[mode][f'{m}_median']:>14.3f}s" for m in METRICS)
+                  + (f"{dirty:>9.1f} MB" if dirty is not None else f"{'-':>12}"), flush=True)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "check": args.check,
+            "rows": args.rows,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print("\nFörsämringar mot baslinjen:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nInga försämringar mot baslinjen.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
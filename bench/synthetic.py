@@ -0,0 +1,299 @@
+"""
+Syntetiska exporter för prestandamätning av de sex kontrollerna.
+
+Varje generator skapar exakt de kolumner som kontrollens RULES.required kräver,
+med grupper (flexplatser/flextjänster) av ungefär group_size rader och en andel
+deviation_rate grupper, eller rader för radkontroller, med inlagda avvikelser.
+
+Exempel:
+    python -m bench.synthetic slamanlaggningar --rows 100000 -o slam.csv
+"""
+import argparse
+import importlib
+import importlib.util
+from pathlib import Path
+from typing import Callable, Dict, Sequence
+import numpy as np
+import pandas as pd
+
+# Kontrollnamn -> modul med RULES och check_<namn>
+CHECKS: Dict[str, str] = {
+    "dorrtillagg": "views.dorrtillagg_check",
+    "hamtfrekvens": "views.hamtfrekvens_mat_rest",
+    "karl": "views.antalsvarde_individer",
+    "debiteringsgrupp": "views.debiteringsgrupp_check",
+    "prisdel": "views.hamtfrekvens_prisdel",
+    "slamanlaggningar": "views.slamanlaggningar_check",
+}
+
+FORMATS = ("xlsx", "csv", "parquet")
+
+# Hämtfrekvenser sorterade från glesast till tätast
+WEEK_FREQS = ["Var 8:e vecka", "Var 4:e vecka", "Varannan vecka", "1 gång i veckan", "2 gånger i veckan", "3 gånger i veckan"]
+
+AFFARSENHETER = ["SEVAB Återvinning", "EEM Återvinning"]
+FLEXTYPER = ["Kärl 140 l", "Kärl 190 l", "Kärl 370 l", "Container"]
+OMRADEN = ["Norr", "Söder", "Öster", "Väster"]
+
+
+def check_module(name: str):
+    return importlib.import_module(CHECKS[name])
+
+
+def check_function(name: str) -> Callable[[pd.DataFrame], pd.DataFrame]:
+    return getattr(check_module(name), f"check_{name}")
+
+
+def _pick(rng: np.random.Generator, values: Sequence, n: int) -> np.ndarray:
+    return np.asarray(values, dtype=object)[rng.integers(0, len(values), n)]
+
+
+def _groups(rng: np.random.Generator, rows: int, group_size: float) -> np.ndarray:
+    # Grupp-id per rad, grupperna ligger i följd som i en export sorterad på nyckeln
+    sizes = 1 + rng.poisson(max(group_size - 1, 0), rows)
+    return np.repeat(np.arange(rows), sizes)[:rows]
+
+
+def _text(prefix: str, values: np.ndarray) -> list:
+    return [f"{prefix}{v}" for v in values]
+
+
+def _common(rng: np.random.Generator, group: np.ndarray) -> Dict[str, object]:
+    # Identifierande kolumner, kunden och adressen följer gruppen
+    n = len(group)
+    return {
+        "Affärsenhet": _pick(rng, AFFARSENHETER, n),
+        "Kundnummer": 100000 + group,
+        "Kundnr": 100000 + group,
+        "Flexplatsadress": _text("Storgatan ", group),
+        "Flextjänst": 500000 + np.arange(n),
+        "Flextyp": _pick(rng, FLEXTYPER, n),
+        "Avtalsnummer": 700000 + group,
+        "Status": np.full(n, "Aktiv", dtype=object),
+        "Avtalsstatus": np.full(n, "Aktiv", dtype=object),
+        "Status flextjänst": np.full(n, "Aktiv", dtype=object),
+    }
+
+
+def _deviating_groups(rng: np.random.Generator, group: np.ndarray, rate: float) -> np.ndarray:
+    # Per rad: True om radens grupp ska få en avvikelse
+    return (rng.random(group[-1] + 1 if len(group) else 0) < rate)[group]
+
+
+def _first_in_group(group: np.ndarray) -> np.ndarray:
+    first = np.ones(len(group), dtype=bool)
+    first[1:] = group[1:] != group[:-1]
+    return first
+
+
+def gen_dorrtillagg(rng, rows, group_size, rate):
+    group = _groups(rng, rows, group_size)
+    cols = _common(rng, group)
+    first = _first_in_group(group)
+
+    # Första raden på varje flexplats är kärl, resten kärl eller tillägg
+    is_tillagg = ~first & (rng.random(rows) < 0.4)
+    freq_idx = rng.integers(0, len(WEEK_FREQS), group[-1] + 1 if rows else 0)[group]
+
+    deviating = _deviating_groups(rng, group, rate)
+    # Hälften av avvikelserna får annan frekvens på tillägget, hälften saknar kärl
+    other_freq = deviating & is_tillagg & (rng.random(rows) < 0.5)
+    freq_idx = np.where(other_freq, (freq_idx + 1) % len(WEEK_FREQS), freq_idx)
+    only_tillagg = deviating & (group % 2 == 0)
+    is_tillagg |= only_tillagg
+
+    cols.update({
+        "Flexplats": _text("FP", group),
+        "Flexgrupp": np.where(is_tillagg, "Tillägg", "Kärl").astype(object),
+        "Hämtfrekvens": np.asarray(WEEK_FREQS, dtype=object)[freq_idx],
+    })
+    return cols
+
+
+def gen_hamtfrekvens(rng, rows, group_size, rate):
+    group = _groups(rng, rows, group_size)
+    cols = _common(rng, group)
+
+    # Restavfallets frekvens per flexplats, matavfallet hämtas lika ofta eller glesare
+    rest_idx = rng.integers(0, len(WEEK_FREQS), group[-1] + 1 if rows else 0)[group]
+    fraktion = _pick(rng, ["Matavfall", "Restavfall", "Restavfall nollvision", "Papper"], rows)
+    is_mat = fraktion == "Matavfall"
+    mat_idx = np.maximum(rest_idx - rng.integers(0, 2, rows), 0)
+
+    deviating = _deviating_groups(rng, group, rate)
+    mat_idx = np.where(deviating, np.minimum(rest_idx + 1, len(WEEK_FREQS) - 1), mat_idx)
+    # Ett mattillfälle tätare än resten kräver att resten inte redan är tätast
+    rest_idx = np.where(deviating & (rest_idx == len(WEEK_FREQS) - 1), rest_idx - 1, rest_idx)
+
+    cols.update({
+        "Flexplats": _text("FP", group),
+        "Fraktion": fraktion,
+        "Hämtfrekvens": np.asarray(WEEK_FREQS, dtype=object)[np.where(is_mat, mat_idx, rest_idx)],
+    })
+    return cols
+
+
+def gen_karl(rng, rows, group_size, rate):
+    group = _groups(rng, rows, group_size)
+    cols = _common(rng, group)
+    size = np.bincount(group)[group]
+
+    # Antal kärl ska motsvara antalet individer med extern referens
+    deviating = _deviating_groups(rng, group, rate)
+    antal = np.where(deviating, size + 1, size)
+
+    cols.update({
+        "Flextjänstnr": 900000 + group,
+        "Fraktion": _pick(rng, ["Restavfall", "Matavfall"], rows),
+        "Extern referens": _text("ID", np.arange(rows)),
+        "Antal kärl": antal,
+    })
+    return cols
+
+
+def gen_debiteringsgrupp(rng, rows, group_size, rate):
+    group = _groups(rng, rows, group_size)
+    cols = _common(rng, group)
+
+    prislista = _pick(rng, ["ÅVM Fritidshus", "ÅVM En- och två bostadshus"], rows)
+    is_sevab = cols["Affärsenhet"] == "SEVAB Återvinning"
+    expected = np.where(is_sevab | (prislista == "ÅVM En- och två bostadshus"), "Månad", "Månad maj-sept")
+
+    # Avvikande rader får en debiteringsgrupp som kontrolleras men inte stämmer
+    deviating = rng.random(rows) < rate
+    wrong = np.where(expected == "Månad", "Månad maj-sept", "Månad")
+    debitering = np.where(deviating, wrong, expected).astype(object)
+    ignored = ~deviating & (rng.random(rows) < 0.1)
+    debitering[ignored] = _pick(rng, ["Kvartal", "BRI", "Varannan månad"], int(ignored.sum()))
+
+    cols.update({"Prislista": prislista, "Debiteringsgrupp": debitering})
+    return cols
+
+
+def gen_prisdel(rng, rows, group_size, rate):
+    group = _groups(rng, rows, group_size)
+    cols = _common(rng, group)
+
+    freq_idx = rng.integers(0, len(WEEK_FREQS), rows)
+    deviating = rng.random(rows) < rate
+    pris_idx = np.where(deviating, (freq_idx + 1) % len(WEEK_FREQS), freq_idx)
+    flextyp = cols["Flextyp"]
+
+    cols.update({
+        "Hämtfrekvens": np.asarray(WEEK_FREQS, dtype=object)[freq_idx],
+        "Prisdel": [f"{t} {WEEK_FREQS[i].lower()}" for t, i in zip(flextyp, pris_idx)],
+    })
+    return cols
+
+
+def gen_slamanlaggningar(rng, rows, group_size, rate):
+    # Antalet tömningar per år styr hur många rader flextjänsten har
+    group = _groups(rng, rows, min(group_size, 12))
+    cols = _common(rng, group)
+    size = np.bincount(group)[group]
+    week = rng.integers(1, 53, group[-1] + 1 if rows else 0)[group]
+    omrade = _pick(rng, OMRADEN, group[-1] + 1 if rows else 0)[group]
+
+    hamt = np.array([f"{n} gång per år" if n == 1 else f"{n} gånger per år" for n in range(13)], dtype=object)[
+        np.minimum(size, 12)]
+    ind = np.asarray(_text("Vecka ", week), dtype=object)
+    kort = np.asarray(_text("Slam vecka ", week), dtype=object)
+    omrade_plats = omrade.copy()
+
+    # Avvikelser: fel antal enligt hämtfrekvens, annat veckonummer eller annat utförandeområde
+    deviating = _deviating_groups(rng, group, rate)
+    kind = rng.integers(0, 3, rows)
+    hamt = np.where(deviating & (kind == 0), hamt[np.minimum(size + 1, 12)], hamt)
+    kort = np.where(deviating & (kind == 1), _text("Slam vecka ", week % 52 + 1), kort)
+    omrade_plats = np.where(deviating & (kind == 2), np.roll(omrade, 1), omrade_plats)
+
+    cols.update({
+        "Flextjänstnr": 900000 + group,
+        "Flexgrupp namn": np.full(rows, "Slam", dtype=object),
+        "Utförandeområde flextjänst": omrade,
+        "Utförandeområde flexplats": omrade_plats,
+        "Hämtfrekvens": hamt,
+        "Ind. körtursplan": ind,
+        "Körtursnamn": kort,
+    })
+    return cols
+
+
+GENERATORS: Dict[str, Callable] = {
+    "dorrtillagg": gen_dorrtillagg,
+    "hamtfrekvens": gen_hamtfrekvens,
+    "karl": gen_karl,
+    "debiteringsgrupp": gen_debiteringsgrupp,
+    "prisdel": gen_prisdel,
+    "slamanlaggningar": gen_slamanlaggningar,
+}
+
+
+def generate(check: str, rows: int, group_size: float = 3, deviation_rate: float = 0.05,
+             seed: int = 0) -> pd.DataFrame:
+    """
+    Skapar en syntetisk export med kolumnerna i kontrollens RULES.required,
+    i bokstavsordning så att samma parametrar alltid ger samma fil.
+    """
+    if check not in GENERATORS:
+        raise ValueError(f"Okänd kontroll: {check}")
+    if rows < 1:
+        raise ValueError("Antal rader måste vara minst 1")
+
+    rng = np.random.default_rng(seed)
+    cols = GENERATORS[check](rng, rows, group_size, deviation_rate)
+    required = sorted(check_module(check).RULES.required)
+    return pd.DataFrame({col: cols[col] for col in required})
+
+
+def _require_pyarrow() -> None:
+    if importlib.util.find_spec("pyarrow") is None:
+        raise RuntimeError("Parquet kräver paketet pyarrow (pip install pyarrow)")
+
+
+def write_export(df: pd.DataFrame, path: Path) -> None:
+    # Formatet bestäms av filändelsen
+    path = Path(path)
+    fmt = path.suffix.lstrip(".").lower()
+    if fmt == "xlsx":
+        df.to_excel(path, index=False, engine="xlsxwriter")
+    elif fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "parquet":
+        _require_pyarrow()
+        df.to_parquet(path, index=False)
+    else:
+        raise ValueError(f"Okänt format: {fmt}, välj bland {', '.join(FORMATS)}")
+
+
+def read_raw(path: Path) -> pd.DataFrame:
+    # Läser en syntetisk export utan validering, se bench.run_benchmarks för hela inläsningssteget
+    path = Path(path)
+    fmt = path.suffix.lstrip(".").lower()
+    if fmt == "xlsx":
+        return pd.read_excel(path)
+    if fmt == "csv":
+        return pd.read_csv(path)
+    if fmt == "parquet":
+        _require_pyarrow()
+        return pd.read_parquet(path)
+    raise ValueError(f"Okänt format: {fmt}, välj bland {', '.join(FORMATS)}")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Skapa en syntetisk export för en kontroll")
+    parser.add_argument("check", choices=sorted(CHECKS))
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--group-size", type=float, default=3)
+    parser.add_argument("--deviation-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=Path, required=True, help="Filändelsen väljer format (xlsx, csv, parquet)")
+    args = parser.parse_args(argv)
+
+    df = generate(args.check, args.rows, args.group_size, args.deviation_rate, args.seed)
+    write_export(df, args.output)
+    print(f"Skrev {len(df)} rader till {args.output}")
+
+
+if __name__ == "__main__":
+    main()
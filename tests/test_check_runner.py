@@ -0,0 +1,57 @@
+"""
+Jämförelsen med förra uppladdningen (bladen Nya, Åtgärdade och Kvarstående)
+ska bygga på exportens affärsenheter, även när exporten laddas upp som flera
+filer eller läses i delar.
+
+    python -m pytest tests
+"""
+import pandas as pd
+import pytest
+
+from bench.synthetic import check_function, check_module, generate, write_export
+from utils import dataset_cache, incremental
+from utils.check_runner import run_check
+
+CHECK = "debiteringsgrupp"
+ROWS = 400
+
+
+@pytest.fixture(autouse=True)
+def _isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_cache, "CACHE_MAX_FILES", 0)
+    monkeypatch.setattr(incremental, "STATE_DIR", tmp_path / "state")
+
+
+def _files(tmp_path, name: str, deviation_rate: float) -> list:
+    # En fil per affärsenhet, som när de exporteras var för sig
+    raw = generate(CHECK, ROWS, deviation_rate=deviation_rate, seed=7)
+    paths = []
+    for i, (_, part) in enumerate(raw.groupby("Affärsenhet", sort=True)):
+        path = tmp_path / f"{name}_{i}.xlsx"
+        write_export(part.reset_index(drop=True), path)
+        paths.append(path)
+    return paths
+
+
+def _run(paths, output, partitions=None) -> dict:
+    input_path = paths if len(paths) > 1 else paths[0]
+    run_check(CHECK, check_module(CHECK).RULES, check_function(CHECK), input_path, output, partitions)
+    return pd.read_excel(output, sheet_name=None)
+
+
+@pytest.mark.parametrize("partitions", [None, 2])
+def test_multi_file_upload_is_compared_with_previous(tmp_path, partitions):
+    first = _run(_files(tmp_path, "forsta", 0.05), tmp_path / "ut1.xlsx", partitions)
+    assert list(first) == ["Avvikelser"] and len(first["Avvikelser"]) > 0
+
+    # Alla avvikelser åtgärdade, även om ingen avvikelse finns kvar att ta affärsenheterna från
+    second = _run(_files(tmp_path, "andra", 0.0), tmp_path / "ut2.xlsx", partitions)
+    assert len(second["Avvikelser"]) == 0
+    assert len(second["Åtgärdade"]) == len(first["Avvikelser"])
+
+
+def test_other_business_unit_is_not_resolved(tmp_path):
+    sevab, eem = sorted(_files(tmp_path, "enheter", 0.05), key=lambda p: p.name)
+    _run([sevab], tmp_path / "ut1.xlsx", partitions=2)
+    second = _run([eem], tmp_path / "ut2.xlsx")
+    assert list(second) == ["Avvikelser"]
@@ -0,0 +1,89 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Set, Tuple, Union
+import pandas as pd
+
+from utils import export_store, metrics
+from utils.chunked import evaluate_chunked
+from utils.deviation_diff import compare_with_previous
+from utils.export_utils import export_units, read_export, scope_name, write_deviations
+from utils.file_utils import source_name
+from utils.parallel import configured_workers
+from utils.rules import RuleSet
+
+# Kolumnen med filen varje avvikelse kommer från när flera filer kontrolleras tillsammans
+SOURCE_COLUMN = "Källfil"
+
+
+def _evaluate(check: str, rules: RuleSet, check_fn: Callable[..., pd.DataFrame], input_path: Path,
+              partitions: Optional[int]) -> Tuple[Optional[pd.DataFrame], pd.DataFrame, Set[str]]:
+    # Exportens rader (None om den lästs i delar), avvikelserna och exportens affärsenheter
+    if partitions:
+        # Filen ryms inte i minnesbudgeten, läs och utvärdera den i delar
+        units: Set[str] = set()
+        return None, evaluate_chunked(input_path, rules, partitions, units=units), units
+    df = read_export(input_path, rules.required)
+    # Ögonblicksbild per kontroll och affärsenheter, inte per filnamn, så att de inte blir fler för varje uppladdning
+    units = export_units(df)
+    scope = scope_name(units)
+    return df, check_fn(df, snapshot=f"{check}.{scope}" if scope else check), units
+
+
+def _check_file(check: str, rules: RuleSet, check_fn: Callable[..., pd.DataFrame], input_path: Path,
+                partitions: Optional[int]) -> Tuple[pd.DataFrame, Set[str]]:
+    # En fil i en samlad uppladdning
+    df, out_df, units = _evaluate(check, rules, check_fn, input_path, partitions)
+    export_store.append(check, input_path, df, out_df)
+    out_df.insert(0, SOURCE_COLUMN, source_name(input_path))
+    return out_df, units
+
+
+def _serial_worker() -> None:
+    # Filerna delar redan på processerna, kontrollerna och bladen i dem tolkas seriellt
+    os.environ["PARALLEL_WORKERS"] = "1"
+    os.environ["SHEET_WORKERS"] = "1"
+
+
+def check_files(check: str, rules: RuleSet, check_fn: Callable[..., pd.DataFrame], input_paths: Sequence[Path],
+                partitions: Optional[int] = None) -> Tuple[pd.DataFrame, Set[str]]:
+    """
+    Kontrollerar filerna var för sig, i en processpool med upp till
+    PARALLEL_WORKERS processer, och slår ihop avvikelserna i filernas ordning
+    med källfilen i SOURCE_COLUMN. Returnerar även filernas affärsenheter.
+    """
+    workers = min(configured_workers(), len(input_paths))
+    tasks = [(check, rules, check_fn, path, partitions) for path in input_paths]
+    with metrics.stage("files"):
+        if workers <= 1:
+            results: List[Tuple[pd.DataFrame, Set[str]]] = [_check_file(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_serial_worker) as pool:
+                results = list(pool.map(_check_file, *zip(*tasks)))
+    metrics.count("files", len(input_paths))
+    units = set().union(*(file_units for _, file_units in results))
+    return pd.concat([out_df for out_df, _ in results], ignore_index=True), units
+
+
+def run_check(check: str, rules: RuleSet, check_fn: Callable[..., pd.DataFrame],
+              input_path: Union[Path, Sequence[Path]], output_path: Path,
+              partitions: Optional[int] = None, col_width: int = 30) -> int:
+    """
+    Gemensamt flöde för en kontroll av en uppladdad fil: läs och utvärdera
+    (i delar om partitions är satt), jämför med förra körningen, spara i den
+    lokala lagringen och skriv rapporten. Returnerar antalet avvikelser.
+    Med flera filer kontrolleras de med check_files och ger en gemensam rapport.
+    """
+    if isinstance(input_path, (str, Path)):
+        df, out_df, units = _evaluate(check, rules, check_fn, input_path, partitions)
+        export_store.append(check, input_path, df, out_df)
+    else:
+        out_df, units = check_files(check, rules, check_fn, input_path, partitions)
+
+    # Nya, åtgärdade och kvarstående avvikelser sedan förra körningen av samma affärsenheter
+    sheets = compare_with_previous(check, out_df, rules, scope_name(units))
+
+    # Skriv resultat till Excel
+    write_deviations(out_df, output_path, col_width, sheets=sheets)
+
+    return len(out_df)
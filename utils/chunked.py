@@ -0,0 +1,158 @@
+"""
+Utvärdering i delar för exporter som inte ryms i minnet.
+
+Exportens blad läses strömmande med openpyxl i batcher. Har kontrollen bara radregler
+utvärderas varje batch direkt. Annars fördelas raderna med en hash av
+gruppnyckeln (RuleSet.partition_key) på partitioner som skrivs till disk, så
+att varje partition innehåller hela grupper och kan utvärderas för sig.
+Delresultaten slås ihop med RuleSet.merge i samma ordning som vid en vanlig
+körning, och minnet begränsas av den största partitionen i stället för filen.
+"""
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Iterator, List, Optional, Set
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from utils import metrics
+from utils.export_utils import export_units, prepare_export
+from utils.rules import RuleResult, RuleSet
+from utils.workbook import column_names, export_sheets
+
+# Rader per batch vid strömmande inläsning
+BATCH_ROWS = 50_000
+
+
+def read_header(input_path: Path) -> List[str]:
+    wb = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        header = next(export_sheets(wb)[0].iter_rows(max_row=1, values_only=True), ())
+        return column_names(header)
+    finally:
+        wb.close()
+
+
+def iter_batches(input_path: Path, batch_rows: int = BATCH_ROWS) -> Iterator[pd.DataFrame]:
+    """
+    Läser exportens blad (se utils/workbook.py) i batcher. Batcherna har
+    object-kolumner med cellernas värden i det första bladets kolumnordning och
+    ett löpande radindex över alla blad. Tomma rader hoppas över.
+    """
+    wb = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        start, first = 0, None
+        for ws in export_sheets(wb):
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            columns = column_names(header)
+            first = first or columns
+            width = len(columns)
+
+            batch = []
+            for row in rows:
+                if all(v is None for v in row):
+                    continue
+                batch.append(tuple(row[:width]) + (None,) * (width - len(row)))
+                if len(batch) >= batch_rows:
+                    yield _batch_frame(batch, columns, first, start)
+                    start += len(batch)
+                    batch = []
+            if batch:
+                yield _batch_frame(batch, columns, first, start)
+                start += len(batch)
+    finally:
+        wb.close()
+
+
+def _batch_frame(batch: list, columns: List[str], first: List[str], start: int) -> pd.DataFrame:
+    df = pd.DataFrame(batch, columns=columns, dtype=object, index=pd.RangeIndex(start, start + len(batch)))
+    # Senare blad kan ha kolumnerna i en annan ordning
+    return df if columns == first else df.reindex(columns=first)
+
+
+def key_text(value) -> str:
+    # Samma nyckel ska alltid hamna i samma partition, oavsett om cellen lästs som 5 eller 5.0
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def partition_of(keys: pd.Series, partitions: int) -> np.ndarray:
+    # Partition per rad, hashen beräknas en gång per unikt nyckelvärde
+    codes, uniques = pd.factorize(keys)
+    hashes = pd.util.hash_array(np.array([key_text(u) for u in uniques] + ["nan"], dtype=object))
+    return (hashes % np.uint64(partitions)).astype(np.int64)[codes]
+
+
+def _spill(batches: Iterator[pd.DataFrame], key: str, partitions: int, spill_dir: Path) -> List[Path]:
+    # Skriv varje batchs rader till respektive partitionsfil, en pickle per batch och partition
+    paths = [spill_dir / f"partition_{p}.pkl" for p in range(partitions)]
+    handles = [open(path, "wb") for path in paths]
+    try:
+        for batch in batches:
+            part = partition_of(batch[key], partitions)
+            for p in np.unique(part):
+                pickle.dump(batch[part == p], handles[p], protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for handle in handles:
+            handle.close()
+    return paths
+
+
+def _load(path: Path) -> Optional[pd.DataFrame]:
+    pieces = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                pieces.append(pickle.load(f))
+            except EOFError:
+                break
+    if not pieces:
+        return None
+    return pd.concat(pieces) if len(pieces) > 1 else pieces[0]
+
+
+def _evaluate(df: pd.DataFrame, rules: RuleSet) -> RuleResult:
+    # Kolumntyper härleds per del, sedan samma validering och komprimering som vid vanlig inläsning
+    df = prepare_export(df.infer_objects(), rules.required)
+    with metrics.stage("evaluate"):
+        return rules.evaluate_part(df)
+
+
+def _collect_units(batches: Iterator[pd.DataFrame], units: Set[str]) -> Iterator[pd.DataFrame]:
+    for batch in batches:
+        units.update(export_units(batch))
+        yield batch
+
+
+def evaluate_chunked(input_path: Path, rules: RuleSet, partitions: int, batch_rows: int = BATCH_ROWS,
+                     spill_dir: Optional[Path] = None, units: Optional[Set[str]] = None) -> pd.DataFrame:
+    # units fylls med exportens affärsenheter när den anges, raderna finns aldrig i minnet samtidigt
+    missing = rules.required - set(read_header(input_path))
+    if missing:
+        raise ValueError(f"Saknar kolumner: {', '.join(missing)}")
+
+    batches = iter_batches(input_path, batch_rows)
+    if units is not None:
+        batches = _collect_units(batches, units)
+
+    key = rules.partition_key
+    results = []
+    if key is None:
+        # Bara radregler, varje batch kan utvärderas direkt
+        for batch in batches:
+            results.append(_evaluate(batch, rules))
+        return rules.merge(results)
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        with metrics.stage("read"):
+            paths = _spill(batches, key, partitions, Path(tmp))
+        for path in paths:
+            df = _load(path)
+            if df is not None:
+                results.append(_evaluate(df, rules))
+    return rules.merge(results)
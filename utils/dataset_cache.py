@@ -0,0 +1,107 @@
+"""
+Delad cache för inlästa exporter mellan uWSGI-processer.
+
+En inläst export sparas en gång som Arrow IPC-fil, med innehållets hash och
+inläsningens version som namn (se export_utils.read_export). Andra processer
+som får samma fil minnesmappar Arrow-filen skrivskyddat i stället för att läsa
+Excel-filen igen. Numeriska kolumner utan saknade värden blir skrivskyddade
+vyer direkt i den delade mappningen och räknas en gång oavsett antal processer.
+Lågkardinala textkolumner lagras som Arrow-dictionary och blir Categorical, så
+bara heltalskoderna kopieras. Övriga textkolumner blir Python-strängar i varje
+process. Exporter där en kolumn inte kan lagras i Arrow (t.ex. blandade typer)
+cachas inte.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+import pyarrow as pa
+
+from utils.file_utils import BASE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Utanför uppladdningsmappen, som töms vid varje uppladdning
+CACHE_DIR = Path(os.environ.get("DATASET_CACHE_DIR") or BASE_DIR / "cache")
+
+# Antal exporter som behålls, de som använts minst nyligen tas bort först
+CACHE_MAX_FILES = int(os.environ.get("DATASET_CACHE_MAX_FILES") or 20)
+
+
+def enabled() -> bool:
+    return CACHE_MAX_FILES > 0
+
+
+def content_hash(input_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(input_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_path(key: str) -> Path:
+    return CACHE_DIR / f"{key}.arrow"
+
+
+def load(key: str) -> Optional[pd.DataFrame]:
+    # Minnesmappa en tidigare publicerad export, None om den saknas
+    if not enabled():
+        return None
+    path = _cache_path(key)
+    try:
+        source = pa.memory_map(str(path), "r")
+        table = pa.ipc.open_file(source).read_all()
+        # Markera som nyligen använd
+        os.utime(path)
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    # Varje kolumn i ett eget block, så att numeriska kolumner kan peka direkt in i mappningen
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    # Saknade textvärden blir None från Arrow men NaN från read_excel
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+def store(key: str, df: pd.DataFrame) -> None:
+    # Publicera atomiskt: skriv till temporär fil i samma katalog och byt namn
+    if not enabled():
+        return
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        logger.info("Exporten kan inte cachas som Arrow: %s", e)
+        return
+
+    tmp = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, _cache_path(key))
+    except OSError as e:
+        logger.warning("Kunde inte spara exporten i cachen: %s", e)
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+        return
+    _prune()
+
+
+def _prune() -> None:
+    # Andra processer kan ha en borttagen fil minnesmappad, den försvinner först när de släpper den
+    try:
+        files = sorted(CACHE_DIR.glob("*.arrow"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in files[CACHE_MAX_FILES:]:
+            path.unlink()
+    except OSError:
+        pass
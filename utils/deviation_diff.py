@@ -0,0 +1,65 @@
+"""
+Jämförelse av avvikelser mellan körningar av samma kontroll.
+
+Varje avvikelse får ett fingeravtryck av kontrollen, kolumnerna i
+RuleSet.identity och Orsak. Föregående körnings fingeravtryck och avvikelser
+sparas per kontroll och affärsenheter (export_utils.export_scope) i STATE_DIR,
+så att en uppladdning jämförs med förra uppladdningen av samma affärsenheter.
+Den nya körningen delas upp i nya och
+kvarstående avvikelser; föregående avvikelser som inte finns kvar är
+åtgärdade. Uppslagningarna görs med hashtabeller, linjärt i antalet avvikelser.
+"""
+from typing import Dict, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.chunked import key_text
+from utils.export_utils import category_codes
+from utils.incremental import load_snapshot, store_snapshot
+from utils.rules import RuleSet
+
+
+def _texts(series: pd.Series) -> np.ndarray:
+    # Värdena som text per unikt värde, så att t.ex. 5 och 5.0 ger samma fingeravtryck
+    codes, uniques = category_codes(series)
+    return np.array([key_text(u) for u in uniques] + [""], dtype=object)[codes]
+
+
+def fingerprints(check: str, out_df: pd.DataFrame, identity: Sequence[str]) -> np.ndarray:
+    cols = [c for c in list(identity) + ["Orsak"] if c in out_df.columns]
+    parts = {"Kontroll": np.full(len(out_df), check, dtype=object)}
+    parts.update({col: _texts(out_df[col]) for col in cols})
+    return pd.util.hash_pandas_object(pd.DataFrame(parts), index=False).to_numpy()
+
+
+def diff_deviations(previous: pd.DataFrame, previous_fps: np.ndarray,
+                    out_df: pd.DataFrame, fps: np.ndarray) -> Dict[str, pd.DataFrame]:
+    # Bladen i jämförelserapporten, i den ordning de skrivs
+    persisting = pd.Series(fps).isin(previous_fps).to_numpy()
+    resolved = ~pd.Series(previous_fps).isin(fps).to_numpy()
+    return {
+        "Nya": out_df[~persisting],
+        "Åtgärdade": previous[resolved],
+        "Kvarstående": out_df[persisting],
+    }
+
+
+def compare_with_previous(check: str, out_df: pd.DataFrame, rules: RuleSet,
+                          scope: str = "") -> Optional[Dict[str, pd.DataFrame]]:
+    """
+    Jämför avvikelserna med föregående körning av check för samma scope och
+    sparar dem som jämförelsegrund för nästa. None om det inte finns någon
+    föregående körning.
+    """
+    fps = fingerprints(check, out_df, rules.identity)
+    name = f"{check}_avvikelser.{scope}" if scope else f"{check}_avvikelser"
+    previous = load_snapshot(name)
+    store_snapshot(name, {"fingerprints": fps, "deviations": out_df})
+    if previous is None:
+        return None
+
+    sheets = diff_deviations(previous["deviations"], previous["fingerprints"], out_df, fps)
+    metrics.count("deviations_new", len(sheets["Nya"]))
+    metrics.count("deviations_resolved", len(sheets["Åtgärdade"]))
+    return sheets
@@ -0,0 +1,53 @@
+from typing import Any, Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+
+class DeviationCollector:
+    """
+    Samlar avvikelser kolumnvis i stället för en dict per rad.
+
+    Varje anrop till add_rows lägger till ett helt urval av rader ur källramen
+    (positioner eller boolesk mask) plus kolumner som beräknats för urvalet.
+    Resultatets index är källramens radetiketter och kolumnordningen bestäms
+    av columns.
+    """
+
+    def __init__(self, columns: List[str]):
+        self.columns = list(columns)
+        self._parts: List[pd.DataFrame] = []
+
+    def __len__(self) -> int:
+        return sum(len(p) for p in self._parts)
+
+    def add_rows(self, source: pd.DataFrame, positions, values: Optional[Dict[str, Any]] = None) -> None:
+        positions = np.asarray(positions)
+        if positions.dtype == bool:
+            positions = np.flatnonzero(positions)
+        if len(positions) == 0:
+            return
+
+        values = values or {}
+        take = [c for c in self.columns if c in source.columns and c not in values]
+        part = source.iloc[positions].loc[:, take]
+        part.index = pd.Index(source.index[positions], name="rad")
+        for col, val in values.items():
+            if isinstance(val, pd.Series):
+                val = val.array
+            elif isinstance(val, list):
+                # Listor kan innehålla listor, som ska stanna som ett värde per rad
+                val = pd.Series(val, dtype=object).array
+            part[col] = val
+        self._parts.append(part)
+
+    def add_frame(self, part: pd.DataFrame) -> None:
+        # Redan insamlade avvikelser, t.ex. från en annan del av exporten
+        if len(part):
+            self._parts.append(part)
+
+    def to_frame(self) -> pd.DataFrame:
+        # Kolumner som inget urval har fyllt i utelämnas, precis som när en dict saknar nyckeln
+        if not self._parts:
+            return pd.DataFrame(columns=self.columns)
+        out_df = pd.concat(self._parts) if len(self._parts) > 1 else self._parts[0]
+        return out_df.loc[:, [c for c in self.columns if c in out_df.columns]]
@@ -0,0 +1,156 @@
+"""
+Lokal lagring av uppladdade exporter och deras avvikelser.
+
+Varje uppladdning läggs till i en SQLite-fil (STORE_PATH) med raderna och
+avvikelserna som JSON och nyckelkolumnerna (Flexplats, Flextjänstnr,
+Kundnummer, Avtalsnummer) som indexerade kolumner. En nyckel kan då slås
+upp direkt, utan att leta fram och läsa om den ursprungliga filen. De
+STORE_MAX_UPLOADS senaste uppladdningarna per kontroll behålls. Lagringen
+innehåller kunduppgifter och är därför avstängd om inte STORE_MAX_UPLOADS satts.
+"""
+import json
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.chunked import key_text
+from utils.export_utils import category_codes
+from utils.incremental import STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Bredvid kontrollernas ögonblicksbilder, utanför uppladdningsmappen
+STORE_PATH = Path(os.environ.get("STORE_PATH") or STATE_DIR / "exporter.sqlite")
+
+# Antal uppladdningar per kontroll som behålls, 0 (standard) stänger av lagringen
+STORE_MAX_UPLOADS = int(os.environ.get("STORE_MAX_UPLOADS") or 0)
+
+# Sökbara nycklar och kolumnerna de heter i de olika exporterna
+KEY_COLUMNS = {
+    "flexplats": ("Flexplats",),
+    "flextjanstnr": ("Flextjänstnr", "Flextjänst"),
+    "kundnummer": ("Kundnummer", "Kundnr"),
+    "avtalsnummer": ("Avtalsnummer",),
+}
+
+# Rader per JSON-serialisering och insert, begränsar minnet för stora exporter
+BATCH_ROWS = 50_000
+
+# Högst så många träffar per tabell i en uppslagning
+LOOKUP_LIMIT = 1000
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS uploads (id INTEGER PRIMARY KEY, kontroll TEXT, filnamn TEXT, tid TEXT)",
+    *[
+        f"CREATE TABLE IF NOT EXISTS {table} (upload_id INTEGER, rad INTEGER, "
+        + ", ".join(f"{key} TEXT" for key in KEY_COLUMNS) + ", data TEXT)"
+        for table in ("rows", "deviations")
+    ],
+    *[
+        f"CREATE INDEX IF NOT EXISTS {table}_{key} ON {table} ({key})"
+        for table in ("rows", "deviations") for key in list(KEY_COLUMNS) + ["upload_id"]
+    ],
+]
+
+
+def enabled() -> bool:
+    return STORE_MAX_UPLOADS > 0
+
+
+def _connect() -> sqlite3.Connection:
+    # WAL så att uppslagningar inte blockeras medan en annan process skriver,
+    # med synchronous=NORMAL räcker en fsync per checkpoint i stället för per commit
+    STORE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(STORE_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def _key_values(df: pd.DataFrame, key: str) -> List[Optional[str]]:
+    # Nyckeln som text per rad (samma form som vid uppslagning), None om kolumnen saknas eller är tom
+    col = next((c for c in KEY_COLUMNS[key] if c in df.columns), None)
+    if col is None:
+        return [None] * len(df)
+    codes, uniques = category_codes(df[col])
+    texts = np.array([key_text(u).strip() for u in uniques] + [None], dtype=object)
+    return texts[codes].tolist()
+
+
+def _insert(conn: sqlite3.Connection, table: str, upload_id: int, df: pd.DataFrame) -> None:
+    for start in range(0, len(df), BATCH_ROWS):
+        part = df.iloc[start:start + BATCH_ROWS]
+        data = part.to_json(orient="records", lines=True, force_ascii=False, date_format="iso").splitlines()
+        columns = [_key_values(part, key) for key in KEY_COLUMNS]
+        labels = part.index.tolist()
+        conn.executemany(
+            f"INSERT INTO {table} VALUES (?, ?, {', '.join('?' for _ in KEY_COLUMNS)}, ?)",
+            zip([upload_id] * len(part), labels, *columns, data),
+        )
+
+
+def append(check: str, input_path: Path, df: Optional[pd.DataFrame], out_df: pd.DataFrame) -> None:
+    """
+    Lägger till en uppladdning av check: exportens rader (df, None om den inte
+    lästs in i sin helhet) och avvikelserna. Fel loggas men fäller aldrig jobbet.
+    """
+    if not enabled():
+        return
+    try:
+        with metrics.stage("store"), closing(_connect()) as conn, conn:
+            cur = conn.execute(
+                "INSERT INTO uploads (kontroll, filnamn, tid) VALUES (?, ?, ?)",
+                (check, Path(input_path).name, datetime.now().isoformat(timespec="seconds")),
+            )
+            upload_id = cur.lastrowid
+            if df is not None:
+                _insert(conn, "rows", upload_id, df)
+            _insert(conn, "deviations", upload_id, out_df)
+            _prune(conn, check)
+    except sqlite3.Error as e:
+        logger.warning("Kunde inte spara uppladdningen i %s: %s", STORE_PATH, e)
+
+
+def _prune(conn: sqlite3.Connection, check: str) -> None:
+    old = [row[0] for row in conn.execute(
+        "SELECT id FROM uploads WHERE kontroll = ? ORDER BY id DESC LIMIT -1 OFFSET ?", (check, STORE_MAX_UPLOADS)
+    )]
+    for upload_id in old:
+        for table in ("rows", "deviations", "uploads"):
+            conn.execute(f"DELETE FROM {table} WHERE {'id' if table == 'uploads' else 'upload_id'} = ?", (upload_id,))
+
+
+def lookup(key: str, value: str) -> Dict[str, list]:
+    """
+    Rader och avvikelser för ett nyckelvärde, senaste uppladdningen först.
+    Kastar ValueError för okända nycklar.
+    """
+    if key not in KEY_COLUMNS:
+        raise ValueError(f"Okänd nyckel '{key}', välj bland {', '.join(KEY_COLUMNS)}")
+
+    result: Dict[str, list] = {"rader": [], "avvikelser": []}
+    if not STORE_PATH.exists():
+        return result
+
+    with closing(_connect()) as conn:
+        for table, name in (("rows", "rader"), ("deviations", "avvikelser")):
+            cursor = conn.execute(
+                f"SELECT u.kontroll, u.filnamn, u.tid, t.rad, t.data FROM {table} t "
+                f"JOIN uploads u ON u.id = t.upload_id WHERE t.{key} = ? "
+                "ORDER BY t.upload_id DESC, t.rad LIMIT ?",
+                (value.strip(), LOOKUP_LIMIT),
+            )
+            result[name] = [
+                {"kontroll": check, "filnamn": filename, "tid": time, "rad": row, "data": json.loads(data)}
+                for check, filename, time, row, data in cursor
+            ]
+    return result
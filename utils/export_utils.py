@@ -0,0 +1,155 @@
+import hashlib
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+
+from utils import dataset_cache, metrics
+from utils.workbook import read_workbook
+
+# Textkolumner med få unika värden som lagras som pandas Categorical
+CATEGORY_COLUMNS = {
+    "Affärsenhet",
+    "Status",
+    "Avtalsstatus",
+    "Status flextjänst",
+    "Fraktion",
+    "Flextyp",
+    "Flexgrupp",
+    "Flexgrupp namn",
+    "Hämtfrekvens",
+    "Prislista",
+    "Prisdel",
+    "Debiteringsgrupp",
+    "Utförandeområde flextjänst",
+    "Utförandeområde flexplats",
+}
+
+# Konvertera bara om antalet unika värden är litet i förhållande till antalet rader
+CATEGORY_MAX_RATIO = 0.5
+
+# Skiljer exporter från olika affärsenheter åt, som laddas upp var för sig
+SCOPE_COLUMN = "Affärsenhet"
+
+# Ingår i nyckeln till den delade cachen, öka när inläsningen eller den cachade formen ändras
+PARSER_VERSION = 2
+
+
+def category_codes(series: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    # Heltalskoder och unika värden, direkt från kategorierna om kolumnen redan är kategorisk
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    codes, uniques = pd.factorize(series)
+    return codes, pd.Index(uniques)
+
+
+def export_units(df: pd.DataFrame) -> Set[str]:
+    # Affärsenheterna i ramen, tom mängd om kolumnen saknas
+    if SCOPE_COLUMN not in df.columns:
+        return set()
+    return {str(u) for u in df[SCOPE_COLUMN].dropna().unique()}
+
+
+def scope_name(units: Iterable[str]) -> str:
+    # Affärsenheterna som ett kort namn, tom sträng utan affärsenheter
+    units = sorted(units)
+    return hashlib.sha1("\n".join(units).encode()).hexdigest()[:12] if units else ""
+
+
+def export_scope(df: pd.DataFrame) -> str:
+    return scope_name(export_units(df))
+
+
+def parse_distinct(series: pd.Series, parser: Callable) -> pd.Series:
+    """
+    Tolkar varje unikt värde en gång till ett tal och sprider resultatet till
+    alla rader. Värden som parser returnerar None för blir NaN.
+    """
+    codes, uniques = category_codes(series)
+    parsed = np.array([parser(u) for u in uniques] + [None], dtype=float)
+    # Kod -1 (saknat värde) pekar på sista elementet, som alltid är NaN
+    return pd.Series(parsed[codes], index=series.index, name=series.name)
+
+
+def compact_categoricals(df: pd.DataFrame, columns: Iterable[str] = CATEGORY_COLUMNS) -> pd.DataFrame:
+    # Gör om lågkardinala textkolumner till Categorical för lägre minnesåtgång
+    for col in columns:
+        if col not in df.columns or df[col].dtype != object:
+            continue
+        codes, uniques = pd.factorize(df[col])
+        if len(uniques) <= CATEGORY_MAX_RATIO * len(df):
+            df[col] = pd.Categorical.from_codes(codes, uniques)
+    return df
+
+
+def map_categories(series: pd.Series, func: Callable) -> pd.Series:
+    """
+    Tillämpar func en gång per unikt värde (inklusive saknat värde) och sprider
+    resultatet till alla rader. Värden som blir lika efter func slås ihop.
+    """
+    codes, uniques = category_codes(series)
+    mapped = pd.Index([func(u) for u in uniques] + [func(np.nan)], dtype=object)
+    # Kod -1 (saknat värde) pekar på sista elementet
+    new_codes, new_uniques = pd.factorize(mapped)
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes[codes], new_uniques),
+        index=series.index,
+        name=series.name,
+    )
+
+
+def _norm_lower(s) -> str:
+    if pd.isna(s):
+        return ""
+    return str(s).strip().lower()
+
+
+def normalized(series: pd.Series) -> pd.Series:
+    # strip/lower per unikt värde, saknade värden blir tom sträng
+    return map_categories(series, _norm_lower)
+
+
+def prepare_export(df: pd.DataFrame, required_cols: Set[str]) -> pd.DataFrame:
+    # Kontrollera obligatoriska kolumner och komprimera textkolumner
+    with metrics.stage("validate"):
+        missing = required_cols - set(df.columns)
+        if missing:
+            raise ValueError(f"Saknar kolumner: {', '.join(missing)}")
+
+        metrics.count("rows", len(df))
+        return compact_categoricals(df)
+
+
+def read_export(input_path: Path, required_cols: Set[str]) -> pd.DataFrame:
+    # Läs in exporten, från den delade cachen om en annan process redan läst samma fil
+    with metrics.stage("read"):
+        key = f"v{PARSER_VERSION}-{dataset_cache.content_hash(input_path)}" if dataset_cache.enabled() else None
+        df = dataset_cache.load(key) if key else None
+        if df is None:
+            # Komprimeras före cachningen så att lågkardinala kolumner lagras som Arrow-dictionary
+            df = compact_categoricals(read_workbook(input_path))
+            if key:
+                dataset_cache.store(key, df)
+    return prepare_export(df, required_cols)
+
+
+def _write_sheet(writer: pd.ExcelWriter, out_df: pd.DataFrame, sheet_name: str, col_width: int) -> None:
+    out_df.to_excel(writer, index=False, sheet_name=sheet_name)
+    workbook = writer.book
+    worksheet = writer.sheets[sheet_name]
+
+    header_fmt = workbook.add_format({"align": "left", "bold": True})
+    for col_idx, value in enumerate(out_df.columns):
+        worksheet.write(0, col_idx, value, header_fmt)
+
+    cell_fmt = workbook.add_format({"align": "left"})
+    worksheet.set_column(0, len(out_df.columns) - 1, col_width, cell_fmt)
+
+
+def write_deviations(out_df: pd.DataFrame, output_path: Path, col_width: int = 30,
+                     sheets: Optional[Dict[str, pd.DataFrame]] = None) -> None:
+    # Skriv resultat till Excel, sheets blir extra blad efter avvikelserna
+    with metrics.stage("write"), pd.ExcelWriter(output_path, engine="xlsxwriter") as writer:
+        _write_sheet(writer, out_df, "Avvikelser", col_width)
+        for sheet_name, frame in (sheets or {}).items():
+            _write_sheet(writer, frame, sheet_name, col_width)
@@ -1,9 +1,20 @@
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import uuid
+import zipfile
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
-from typing import Tuple
+from typing import List, Optional, Tuple
 
-ALLOWED_EXT = {"xlsx"}
+ALLOWED_EXT = {"xlsx", "zip"}
+
+# Exporterna i en uppladdning eller ett zip-arkiv
+EXPORT_EXT = {"xlsx"}
+
+# Övre gräns för uppackad storlek per zip-arkiv, skyddar mot zip-bomber
+ZIP_MAX_UNPACKED = 500 * 2**20
+
+# Block vid strömmande uppackning
+_COPY_BYTES = 2**20
 
 # Skapa katalog om den inte finns
 BASE_DIR = Path.cwd()
@@ -15,18 +26,76 @@ def allowed_file(filename: str) -> bool:
     # Kontrollera filändelse
     if not filename:
         return False
-    name = secure_filename(filename)
-    return "." in name and name.rsplit(".", 1)[1].lower() in ALLOWED_EXT
+    return _extension(secure_filename(filename)) in ALLOWED_EXT
+
+
+def _extension(filename: str) -> str:
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex[:8]
 
 
-def create_session_paths(filename: str) -> Tuple[Path, str]:
+def create_session_paths(filename: str, session_id: Optional[str] = None) -> Tuple[Path, str]:
     # Skapa unika filnamn för uppladdning baserat på session id
-    session_id = uuid.uuid4().hex[:8]
+    session_id = session_id or new_session_id()
     safe = secure_filename(filename)
     input_name = f"inkommande_{session_id}_{safe}"
     return UPLOAD_FOLDER / input_name, session_id
 
 
+def source_name(input_path: Path) -> str:
+    # Filnamnet som det laddades upp, utan prefixet från create_session_paths
+    name = Path(input_path).name
+    return name.split("_", 2)[2] if name.startswith("inkommande_") and name.count("_") >= 2 else name
+
+
+def _unpack_zip(file: FileStorage, session_id: str) -> List[Path]:
+    # Packa upp arkivets Excel-filer en i taget direkt från uppladdningsströmmen
+    paths = []
+    unpacked = 0
+    try:
+        with zipfile.ZipFile(file.stream) as archive:
+            for info in archive.infolist():
+                name = PurePosixPath(info.filename).name
+                if info.is_dir() or name.startswith(".") or "__MACOSX" in info.filename:
+                    continue
+                if _extension(name) not in EXPORT_EXT:
+                    continue
+                path, _ = create_session_paths(name, session_id)
+                if path.exists():
+                    raise ValueError(f"Flera filer i uppladdningen heter {name}")
+                with archive.open(info) as src, open(path, "wb") as dst:
+                    for block in iter(lambda: src.read(_COPY_BYTES), b""):
+                        unpacked += len(block)
+                        if unpacked > ZIP_MAX_UNPACKED:
+                            raise ValueError(
+                                f"Zip-arkivet är större än {ZIP_MAX_UNPACKED // 2**20} MB uppackat")
+                        dst.write(block)
+                paths.append(path)
+    except zipfile.BadZipFile:
+        raise ValueError(f"{file.filename} är inte ett giltigt zip-arkiv")
+    if not paths:
+        raise ValueError(f"{file.filename} innehåller inga Excel-filer (.xlsx)")
+    return paths
+
+
+def save_upload(file: FileStorage, session_id: str) -> List[Path]:
+    """
+    Sparar en uppladdad fil i uppladdningsmappen och returnerar sökvägarna till
+    exporterna i den: filen själv, eller Excel-filerna i ett zip-arkiv.
+    Kastar ValueError för trasiga eller tomma arkiv och dubblerade filnamn.
+    """
+    if _extension(secure_filename(file.filename)) == "zip":
+        return _unpack_zip(file, session_id)
+    path, _ = create_session_paths(file.filename, session_id)
+    if path.exists():
+        raise ValueError(f"Flera filer i uppladdningen heter {file.filename}")
+    file.save(path)
+    return [path]
+
+
 def cleanup_folder():
     # Rensa uppladdningsmappen
     for p in UPLOAD_FOLDER.iterdir():
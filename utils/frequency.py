@@ -0,0 +1,62 @@
+import re
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+import pandas as pd
+
+from utils.export_utils import category_codes, parse_distinct
+
+# Mappning från text till numeriskt värde (hämtningar per vecka)
+FREQ_PER_WEEK: Dict[str, float] = {
+    "varannan vecka": 0.5,
+    "1 gång i veckan": 1.0,
+    "2 gånger i veckan": 2.0,
+    "3 gånger i veckan": 3.0,
+    "var 4:e vecka": 1.0 / 4.0,
+    "var 8:e vecka": 1.0 / 8.0,
+}
+
+_NUMBER_RE = re.compile(r'(\d+)')
+
+# Tolkade fritexter som cachas per process. Begränsad, workern lever länge och texterna varierar mellan exporter
+PARSE_CACHE_SIZE = 65536
+
+
+def _norm_freq(s) -> str:
+    if pd.isna(s):
+        return ""
+    return str(s).strip().lower()
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def freq_per_week(s: str) -> Optional[float]:
+    # Antal hämtningar per vecka, None om frekvensen är okänd
+    return FREQ_PER_WEEK.get(_norm_freq(s))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def expected_count(s: str) -> Optional[int]:
+    # Förväntat antal förekomster av en flextjänst (slamtömningar) enligt hämtfrekvensen
+    key = _norm_freq(s)
+    if 'vartannat år' in key or 'vartannat-år' in key:
+        return 1
+
+    m = _NUMBER_RE.search(key)
+    if m:
+        val = int(m.group(1))
+        if 1 <= val <= 12:
+            return val
+    return None
+
+
+def map_frequencies(series: pd.Series, parser: Callable = freq_per_week) -> pd.Series:
+    """
+    Tolkar varje unik frekvenstext en gång och sprider resultatet till alla rader.
+    Okända och tomma värden blir NaN.
+    """
+    return parse_distinct(series, parser)
+
+
+def unknown_frequencies(series: pd.Series, parser: Callable = freq_per_week) -> List[str]:
+    # Samtliga ifyllda frekvenser som inte går att tolka, rapporteras i ett svep
+    _, uniques = category_codes(series)
+    return sorted({str(u) for u in uniques if _norm_freq(u) and parser(u) is None})
@@ -0,0 +1,191 @@
+"""
+Inkrementell omkontroll mot föregående uppladdning av samma export.
+
+Efter varje kontroll sparas en ögonblicksbild per kontroll i STATE_DIR: grupp och
+plats i gruppen per rad (grupperat på RuleSet.partition_key), en signatur per
+grupp och delresultatet. Vid nästa uppladdning jämförs gruppernas signaturer,
+som bygger på en hash per rad. Bara grupper som ändrats eller tillkommit
+utvärderas igen; avvikelserna för övriga grupper återanvänds med radetiketterna
+flyttade till den nya filen. Saknar kontrollen gruppregler är varje rad sin
+egen grupp.
+
+Ögonblicksbilden gäller bara för samma kolumner och samma kod (vyn och alla
+moduler i utils, där tolkningen av t.ex. hämtfrekvenser finns), annars körs
+hela kontrollen.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.file_utils import BASE_DIR
+from utils.parallel import evaluate_parts
+from utils.rules import RuleResult, RuleSet
+
+logger = logging.getLogger(__name__)
+
+# Utanför uppladdningsmappen, som töms vid varje uppladdning
+STATE_DIR = Path(os.environ.get("STATE_DIR") or BASE_DIR / "state")
+
+# Udda konstant som blandar in radens plats i gruppen i hashen
+_RANK_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+@lru_cache(maxsize=None)
+def _rules_version(module: str) -> str:
+    # Ändrad kod i vyn eller i någon modul i utils gör tidigare ögonblicksbilder ogiltiga
+    digest = hashlib.sha256()
+    for path in [Path(sys.modules[module].__file__), *sorted(Path(__file__).parent.glob("*.py"))]:
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+class GroupLayout:
+    """
+    Raderna ordnade per grupp: gruppkod och plats i gruppen per rad samt en
+    signatur per grupp, summan av radhasharna blandade med radens plats i
+    gruppen. Samma rader i samma ordning ger samma signatur.
+    """
+
+    def __init__(self, groups: np.ndarray, hashes: np.ndarray):
+        self.codes, uniques = pd.factorize(groups)
+        self.order = np.argsort(self.codes, kind="stable")
+        counts = np.bincount(self.codes, minlength=len(uniques))
+        self.starts = np.cumsum(counts) - counts
+        self.rank = np.empty(len(groups), dtype=np.int64)
+        self.rank[self.order] = np.arange(len(groups)) - np.repeat(self.starts, counts)
+
+        mixed = pd.util.hash_array(hashes ^ (self.rank.astype(np.uint64) * _RANK_MIX))
+        sums = np.add.reduceat(mixed[self.order], self.starts) if len(groups) else np.empty(0, dtype=np.uint64)
+        self.signatures = pd.Series(sums, index=uniques)
+
+    def position(self, codes: np.ndarray, rank: np.ndarray) -> np.ndarray:
+        # Radposition för plats rank i grupperna codes
+        return self.order[self.starts[codes] + rank]
+
+
+def _path(check: str) -> Path:
+    return STATE_DIR / f"{check}.pkl"
+
+
+def load_snapshot(check: str) -> Optional[dict]:
+    try:
+        with open(_path(check), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        logger.warning("Kunde inte läsa ögonblicksbilden för %s: %s", check, e)
+        return None
+
+
+def store_snapshot(check: str, snapshot: dict) -> None:
+    # Skriv till temporär fil i samma katalog och byt namn, samtidiga läsare ser aldrig en halv fil
+    tmp = None
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=STATE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, _path(check))
+    except OSError as e:
+        logger.warning("Kunde inte spara ögonblicksbilden för %s: %s", check, e)
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def _row_groups(df: pd.DataFrame, rules: RuleSet, hashes: np.ndarray) -> np.ndarray:
+    # Gruppnyckelns hash per rad. En nyckel som lästs med annan typ än förra gången räknas som en ny grupp
+    key = rules.partition_key
+    return hashes if key is None else pd.util.hash_pandas_object(df[key], index=False).to_numpy()
+
+
+def _reuse(result: RuleResult, old_labels: pd.Index, target: np.ndarray, labels: pd.Index) -> RuleResult:
+    # Avvikelser från oförändrade grupper, flyttade till den nya filens radetiketter (target = -1 för övriga)
+    def relabel(frame: pd.DataFrame) -> Tuple[pd.DataFrame, np.ndarray]:
+        positions = target[old_labels.get_indexer(frame.index)]
+        keep = positions >= 0
+        frame = frame[keep]
+        frame.index = pd.Index(labels[positions[keep]], name=frame.index.name)
+        return frame, keep
+
+    rows, keep_rows = relabel(result.rows)
+    groups, keep_groups = relabel(result.groups)
+    row_keys = None if result.row_keys is None else result.row_keys[keep_rows]
+    return RuleResult(rows, row_keys, groups, result.group_keys[keep_groups], result.group_rules[keep_groups])
+
+
+def evaluate_incremental(check: str, df: pd.DataFrame, rules: RuleSet) -> pd.DataFrame:
+    """
+    Utvärderar rules på df och återanvänder avvikelser för grupper som är
+    oförändrade sedan förra ögonblicksbilden av check. Resultatet är detsamma
+    som vid en fullständig utvärdering.
+    """
+    # Alla kolumner hashas, så att även kolumner som bara härledda regler läser räknas
+    columns = [str(c) for c in df.columns]
+    version = _rules_version(rules.module)
+
+    with metrics.stage("diff"):
+        hashes = row_hashes(df)
+        layout = GroupLayout(_row_groups(df, rules, hashes), hashes)
+        labels = df.index
+
+        snapshot = load_snapshot(check)
+        if snapshot is not None and (snapshot["version"], snapshot["columns"]) != (version, columns):
+            snapshot = None
+
+        results = []
+        if snapshot is None:
+            changed = np.ones(len(df), dtype=bool)
+        else:
+            # Föregående filens grupper som koder i den nya filen, -1 om gruppen försvunnit
+            previous = snapshot["signatures"]
+            new_codes = layout.signatures.index.get_indexer(previous.index)
+            found = new_codes >= 0
+            same = np.zeros(len(previous), dtype=bool)
+            same[found] = previous.to_numpy()[found] == layout.signatures.to_numpy()[new_codes[found]]
+
+            unchanged = np.zeros(len(layout.signatures), dtype=bool)
+            unchanged[new_codes[same]] = True
+            changed = ~unchanged[layout.codes]
+
+            # Rader i oförändrade grupper motsvarar raden på samma plats i gruppen i den nya filen
+            old_codes, old_rank = snapshot["codes"], snapshot["rank"]
+            reused = same[old_codes]
+            target = np.full(len(old_codes), -1, dtype=np.int64)
+            target[reused] = layout.position(new_codes[old_codes[reused]], old_rank[reused])
+            results.append(_reuse(snapshot["result"], snapshot["labels"], target, labels))
+            metrics.count("groups_reused", int(same.sum()))
+
+    with metrics.stage("evaluate"):
+        if changed.all():
+            results.extend(evaluate_parts(df, rules))
+        elif changed.any():
+            # Kopia, härledda kolumner läggs till i ramen som utvärderas
+            results.extend(evaluate_parts(df[changed].copy(), rules))
+        result = RuleResult.concat(results)
+        out_df = rules.merge([result])
+
+    store_snapshot(check, {
+        "version": version,
+        "columns": columns,
+        "labels": labels,
+        "codes": layout.codes,
+        "rank": layout.rank,
+        "signatures": layout.signatures,
+        "result": result,
+    })
+    return out_df
@@ -0,0 +1,95 @@
+"""
+Hashjoin mellan två exporter på en eller flera nyckelkolumner.
+
+Nycklarna faktoriseras gemensamt för båda exporterna till täta heltalskoder.
+Koderna används sedan som en direktadresserad hashtabell: högerraderna ordnas
+per kod och varje vänsterrad slår upp sina matchningar via sin kod, utan
+nästlade loopar eller jämförelser per radpar.
+"""
+from typing import Sequence, Tuple
+import numpy as np
+import pandas as pd
+
+from utils.chunked import key_text
+from utils.export_utils import category_codes
+
+
+def _key_strings(series: pd.Series) -> np.ndarray:
+    # Nyckeln som text per rad, så att t.ex. 5 i en export och 5.0 eller "5" i den andra matchar.
+    # Texten bildas en gång per unikt värde, för talkolumner vektoriserat
+    codes, uniques = category_codes(series)
+    if pd.api.types.is_numeric_dtype(uniques.dtype) and not pd.api.types.is_bool_dtype(uniques.dtype):
+        values = uniques.to_numpy(dtype=float)
+        integral = values == np.round(values)
+        texts = np.empty(len(values), dtype=object)
+        texts[integral] = values[integral].astype(np.int64).astype(str)
+        texts[~integral] = values[~integral].astype(str)
+    else:
+        texts = np.array([key_text(u).strip() for u in uniques], dtype=object)
+    return np.append(texts, None)[codes]
+
+
+def key_codes(left: pd.DataFrame, right: pd.DataFrame, keys: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # Gemensamma koder för nyckelkombinationen i båda exporterna, -1 om någon nyckel saknas
+    n_left = len(left)
+    combined = np.zeros(n_left + len(right), dtype=np.int64)
+    valid = np.ones(len(combined), dtype=bool)
+    for key in keys:
+        codes, uniques = pd.factorize(np.concatenate([_key_strings(left[key]), _key_strings(right[key])]))
+        valid &= codes >= 0
+        combined, _ = pd.factorize(combined * (len(uniques) + 1) + (codes + 1))
+    combined[~valid] = -1
+    return combined[:n_left], combined[n_left:]
+
+
+def hash_join(left_codes: np.ndarray, right_codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positioner för alla matchande radpar som (vänster, höger), i vänsterordning
+    och därefter högerordning. Vänsterrader utan matchning tas med en gång
+    med höger -1 (left join).
+    """
+    n_codes = int(max(left_codes.max(initial=-1), right_codes.max(initial=-1))) + 1
+    right_valid = np.flatnonzero(right_codes >= 0)
+    counts = np.bincount(right_codes[right_valid], minlength=n_codes)
+    starts = np.cumsum(counts) - counts
+    right_rows = right_valid[np.argsort(right_codes[right_valid], kind="stable")]
+
+    matched = left_codes >= 0
+    matches = np.zeros(len(left_codes), dtype=np.int64)
+    matches[matched] = counts[left_codes[matched]]
+
+    per_left = np.maximum(matches, 1)
+    left_pos = np.repeat(np.arange(len(left_codes)), per_left)
+    offset = np.arange(len(left_pos)) - np.repeat(np.cumsum(per_left) - per_left, per_left)
+
+    hit = np.repeat(matches > 0, per_left)
+    right_pos = np.full(len(left_pos), -1, dtype=np.int64)
+    first = np.repeat(starts[np.where(matched, left_codes, 0)], per_left)
+    right_pos[hit] = right_rows[(first + offset)[hit]]
+    return left_pos, right_pos
+
+
+def join_exports(left: pd.DataFrame, right: pd.DataFrame, keys: Sequence[str]) -> pd.DataFrame:
+    """
+    Left join av right på left via keys. Resultatet har vänsterns kolumner
+    följt av högerns övriga kolumner (saknas för omatchade rader) samt
+    _vänsterrad och _högerrad med positionerna i respektive export
+    (_högerrad -1 utan matchning).
+    """
+    left_pos, right_pos = hash_join(*key_codes(left, right, keys))
+    out = left.iloc[left_pos].reset_index(drop=True)
+    unmatched = bool((right_pos < 0).any())
+    for col in right.columns:
+        if col not in out.columns:
+            values = right[col]
+            if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+                values = values.array
+            elif unmatched and values.dtype.kind in "iub":
+                # Heltal och booleska värden blir inte flyttal när saknade värden fylls i (10, inte 10.0)
+                values = values.to_numpy(dtype=object)
+            else:
+                values = values.to_numpy()
+            out[col] = pd.api.extensions.take(values, right_pos, allow_fill=True)
+    out["_vänsterrad"] = left_pos
+    out["_högerrad"] = right_pos
+    return out
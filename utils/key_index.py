@@ -0,0 +1,104 @@
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+
+from utils.export_utils import category_codes
+
+
+class KeyIndex:
+    """
+    Faktoriserar en nyckelkolumn (t.ex. Flexplats eller Flextjänstnr) en gång till
+    täta heltalskoder 0..n_groups-1, sorterade som i df.groupby(key).
+    Rader med saknad nyckel får kod -1 och ingår inte i någon grupp.
+    """
+
+    def __init__(self, keys: pd.Series):
+        codes, uniques = pd.factorize(keys, sort=True)
+        self.codes = codes
+        self.keys = pd.Index(uniques)
+        self.n_groups = len(uniques)
+        self._valid = codes >= 0
+
+    def __len__(self) -> int:
+        return self.n_groups
+
+    def key(self, code: int):
+        # Omvänd uppslagning från kod till nyckelvärde
+        return self.keys[code]
+
+    def _select(self, mask: Optional[np.ndarray]) -> np.ndarray:
+        if mask is None:
+            return self._valid
+        return self._valid & np.asarray(mask, dtype=bool)
+
+    def counts(self, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        # Antal rader per grupp, eventuellt begränsat till rader där mask är sann
+        sel = self._select(mask)
+        return np.bincount(self.codes[sel], minlength=self.n_groups)
+
+    def any(self, mask: np.ndarray) -> np.ndarray:
+        return self.counts(mask) > 0
+
+    def nunique(self, values: pd.Series, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        # Antal unika ifyllda värden per grupp
+        value_codes, uniques = category_codes(values)
+        sel = self._select(mask) & (value_codes >= 0)
+        pairs = self.codes[sel].astype(np.int64) * (len(uniques) + 1) + value_codes[sel]
+        group_of_pair = np.unique(pairs) // (len(uniques) + 1)
+        return np.bincount(group_of_pair, minlength=self.n_groups)
+
+    def distinct(self, values: pd.Series, groups: np.ndarray,
+                 mask: Optional[np.ndarray] = None, dropna: bool = True) -> List[list]:
+        # Unika värden per angiven grupp, i ordning efter första förekomst
+        value_codes, uniques = category_codes(values)
+        sel = self._select(mask) & np.isin(self.codes, groups)
+        if dropna:
+            sel &= value_codes >= 0
+        positions = np.flatnonzero(sel)
+        pairs = self.codes[positions].astype(np.int64) * (len(uniques) + 1) + (value_codes[positions] + 1)
+        _, first = np.unique(pairs, return_index=True)
+        positions = positions[np.sort(first)]
+
+        # Stabil sortering per grupp behåller förekomstordningen inom gruppen
+        order = np.argsort(self.codes[positions], kind="stable")
+        group_codes = self.codes[positions][order]
+        lookup = np.append(np.asarray(uniques, dtype=object), np.nan)
+        found = lookup[value_codes[positions][order]]
+
+        starts = np.searchsorted(group_codes, groups, side="left")
+        ends = np.searchsorted(group_codes, groups, side="right")
+        return [found[a:b].tolist() for a, b in zip(starts, ends)]
+
+    def max(self, values: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        # Största värde per grupp, NaN ignoreras och grupper utan värden får NaN
+        return self._reduce(np.fmax, values, mask)
+
+    def min(self, values: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        return self._reduce(np.fmin, values, mask)
+
+    def _reduce(self, ufunc, values: np.ndarray, mask: Optional[np.ndarray]) -> np.ndarray:
+        values = np.asarray(values, dtype=float)
+        sel = self._select(mask)
+        out = np.full(self.n_groups, np.nan)
+        ufunc.at(out, self.codes[sel], values[sel])
+        return out
+
+    def first(self, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        # Position för första raden per grupp, -1 om gruppen saknar rader
+        sel = self._select(mask)
+        positions = np.flatnonzero(sel)
+        out = np.full(self.n_groups, len(self.codes), dtype=np.int64)
+        np.minimum.at(out, self.codes[positions], positions)
+        out[out == len(self.codes)] = -1
+        return out
+
+    def broadcast(self, group_values: np.ndarray, fill=np.nan) -> np.ndarray:
+        # Sprid ett värde per grupp tillbaka till raderna
+        group_values = np.asarray(group_values)
+        out = np.append(group_values, fill)
+        return out[np.where(self._valid, self.codes, self.n_groups)]
+
+    def order(self, positions: np.ndarray) -> np.ndarray:
+        # Sorteringsordning för rader som i groupby: grupp för grupp, radordning inom gruppen
+        positions = np.asarray(positions)
+        return np.lexsort((positions, self.codes[positions]))
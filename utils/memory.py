@@ -0,0 +1,131 @@
+"""
+Minnesmätning och minnesbudget per jobb.
+
+Toppminnet per steg mäts med tracemalloc när det är påslaget (MEMORY_TRACEMALLOC=1)
+och annars med processens högsta RSS (VmHWM), som nollställs i början av varje
+steg via /proc/self/clear_refs. Där det inte går (utanför Linux) mäts inget
+toppminne per steg. Innan en fil läses in uppskattas hur mycket
+minne den kräver, utifrån filstorlek och bladens rader och kolumner, så att jobb som
+skulle överskrida budgeten kan köras i delar (utils/chunked.py) i stället för att
+fälla workern.
+"""
+import math
+import tracemalloc
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from openpyxl import load_workbook
+
+from utils.workbook import export_sheets
+
+# Uppmätt toppminne per cell vid inläsning och kontroll är ca 90 byte, med marginal
+BYTES_PER_CELL = 200
+
+# Reserv när bladet saknar dimension: en xlsx packas upp till mångdubbla storleken i minnet
+BYTES_PER_FILE_BYTE = 50
+
+_STATUS = Path("/proc/self/status")
+_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+# Toppminnet hittills för steg som pågår när ett inre steg nollställer mätningen
+_open_stages: List[int] = []
+
+
+class MemoryBudgetExceeded(ValueError):
+    # Jobbet beräknas kräva mer minne än budgeten tillåter
+
+    def __init__(self, estimate: int, budget: int):
+        self.estimate = estimate
+        self.budget = budget
+        super().__init__(
+            f"Filen beräknas kräva ca {estimate // 2**20} MB minne, "
+            f"vilket överskrider gränsen på {budget // 2**20} MB"
+        )
+
+
+def _reset_hwm() -> bool:
+    # "5" nollställer VmHWM till nuvarande RSS (Linux 4.0+)
+    try:
+        _CLEAR_REFS.write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def _hwm_supported() -> bool:
+    return _reset_hwm()
+
+
+def _hwm() -> Optional[int]:
+    # Processens högsta RSS i byte sedan senaste nollställningen
+    try:
+        for line in _STATUS.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _current_peak() -> Optional[int]:
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    return _hwm() if _hwm_supported() else None
+
+
+def start_peak() -> None:
+    # Nollställ toppvärdet inför ett nytt steg, omgivande steg behåller sitt toppminne hittills
+    current = _current_peak()
+    if current is not None:
+        _open_stages[:] = [max(peak, current) for peak in _open_stages]
+    _open_stages.append(0)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    elif _hwm_supported():
+        _reset_hwm()
+
+
+def stage_peak() -> Optional[int]:
+    # Toppminne sedan start_peak, None om det inte kan mätas per steg
+    before = _open_stages.pop() if _open_stages else 0
+    current = _current_peak()
+    return None if current is None else max(before, current)
+
+
+def sheet_shape(input_path: Path) -> Optional[Tuple[int, int]]:
+    # Rader och kolumner i exportens blad enligt deras dimension, utan att läsa cellerna
+    try:
+        wb = load_workbook(input_path, read_only=True)
+    except Exception:
+        return None
+    try:
+        sheets = export_sheets(wb)
+        if any(ws.max_row is None or ws.max_column is None for ws in sheets):
+            return None
+        return sum(ws.max_row for ws in sheets), max(ws.max_column for ws in sheets)
+    finally:
+        wb.close()
+
+
+def estimate_memory(input_path: Path) -> int:
+    # Uppskattat toppminne i byte utifrån antalet celler, eller filstorleken om dimension saknas
+    shape = sheet_shape(input_path)
+    if shape is None:
+        return Path(input_path).stat().st_size * BYTES_PER_FILE_BYTE
+    rows, cols = shape
+    return rows * cols * BYTES_PER_CELL
+
+
+def check_budget(input_paths: Sequence[Path], budget_mb: Optional[float]) -> int:
+    # Returnerar uppskattningen för filerna tillsammans, kastar MemoryBudgetExceeded om den är över budgeten
+    estimate = sum(estimate_memory(path) for path in input_paths)
+    if budget_mb and estimate > budget_mb * 2**20:
+        raise MemoryBudgetExceeded(estimate, int(budget_mb * 2**20))
+    return estimate
+
+
+def partitions_for(estimate: int, budget: int) -> int:
+    # Antal partitioner så att varje partition använder högst halva budgeten
+    return max(2, math.ceil(estimate / (budget / 2)))
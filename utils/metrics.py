@@ -0,0 +1,245 @@
+"""
+Steg-tider och räknare per kontroll, exporterade i Prometheus textformat.
+
+Ett jobb (en uppladdning) mäts med job(check). Inuti jobbet registrerar
+stage(namn) tid och toppminne för ett steg och count(namn, n) ökar en räknare;
+utanför ett jobb gör båda ingenting, så att bench och andra anrop inte påverkas.
+
+uWSGI kör flera processer, så varje process skriver sina ackumulerade värden
+atomiskt till en egen fil i METRICS_DIR efter varje jobb. /metrics läser och
+summerar alla filer.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from utils import memory
+from utils.file_utils import BASE_DIR
+
+# Utanför uppladdningsmappen, som töms vid varje uppladdning
+METRICS_DIR = Path(os.environ.get("METRICS_DIR") or BASE_DIR / "metrics")
+
+STAGE_HISTOGRAM = "check_stage_duration_seconds"
+MEMORY_HISTOGRAM = "check_stage_peak_memory_bytes"
+ESTIMATE_HISTOGRAM = "check_estimated_memory_bytes"
+
+_MB = 2**20
+
+# Övre gränser för histogrammens hinkar, sekunder respektive byte
+BUCKETS = {
+    STAGE_HISTOGRAM: (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+    MEMORY_HISTOGRAM: tuple(float(mb * _MB) for mb in (32, 64, 128, 256, 512, 1024, 2048, 4096)),
+    ESTIMATE_HISTOGRAM: tuple(float(mb * _MB) for mb in (32, 64, 128, 256, 512, 1024, 2048, 4096)),
+}
+
+# Räknare som jobben kan öka med count(), namn -> hjälptext
+COUNTERS = {
+    "rows": "Antal inlästa rader",
+    "groups": "Antal grupper som gruppreglerna utvärderat",
+    "deviations": "Antal rapporterade avvikelser",
+    "deviations_new": "Antal avvikelser som inte fanns i föregående körning",
+    "deviations_resolved": "Antal avvikelser från föregående körning som är åtgärdade",
+    "chunked": "Antal jobb som körts i delar för att hålla minnesbudgeten",
+    "files": "Antal exportfiler som kontrollerats, flera per jobb vid zip-arkiv eller flera filer",
+    "groups_reused": "Antal grupper vars avvikelser återanvänts från föregående uppladdning",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Labels], dict] = {}
+_counters: Dict[Tuple[str, Labels], float] = {}
+# Unikt per processstart, så att en återanvänd pid inte skriver över en tidigare process värden
+_token = uuid.uuid4().hex[:8]
+
+
+class Job:
+    # Mätvärden för ett pågående jobb, registreras när jobbet avslutas
+
+    def __init__(self, check: str):
+        self.check = check
+        self.status = "ok"
+        self.stages: Dict[str, float] = {}
+        self.memory: Dict[str, int] = {}
+        self.counts: Dict[str, float] = {}
+        self.estimated_memory: Optional[int] = None
+
+
+def current_job() -> Optional[Job]:
+    return getattr(_local, "job", None)
+
+
+@contextmanager
+def job(check: str):
+    current = Job(check)
+    _local.job = current
+    try:
+        yield current
+    except Exception:
+        current.status = "error"
+        raise
+    finally:
+        _local.job = None
+        _record(current)
+        flush()
+
+
+@contextmanager
+def stage(name: str):
+    current = current_job()
+    if current is None:
+        yield
+        return
+    memory.start_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        # Samma steg flera gånger i ett jobb summeras, för minnet gäller det högsta
+        current.stages[name] = current.stages.get(name, 0.0) + time.perf_counter() - start
+        peak = memory.stage_peak()
+        if peak is not None:
+            current.memory[name] = max(current.memory.get(name, 0), peak)
+
+
+def count(name: str, n: float) -> None:
+    current = current_job()
+    if current is not None:
+        current.counts[name] = current.counts.get(name, 0) + n
+
+
+def _observe(name: str, labels: Labels, value: float) -> None:
+    hist = _histograms.setdefault((name, labels), {"buckets": [0] * len(BUCKETS[name]), "sum": 0.0, "count": 0})
+    for i, bound in enumerate(BUCKETS[name]):
+        if value <= bound:
+            hist["buckets"][i] += 1
+            break
+    hist["sum"] += value
+    hist["count"] += 1
+
+
+def _inc(name: str, labels: Labels, n: float) -> None:
+    _counters[(name, labels)] = _counters.get((name, labels), 0) + n
+
+
+def _record(current: Job) -> None:
+    with _lock:
+        for name, seconds in current.stages.items():
+            _observe(STAGE_HISTOGRAM, (("check", current.check), ("stage", name)), seconds)
+        for name, peak in current.memory.items():
+            _observe(MEMORY_HISTOGRAM, (("check", current.check), ("stage", name)), peak)
+        if current.estimated_memory is not None:
+            _observe(ESTIMATE_HISTOGRAM, (("check", current.check),), current.estimated_memory)
+        for name, n in current.counts.items():
+            _inc(f"check_{name}_total", (("check", current.check),), n)
+        _inc("check_jobs_total", (("check", current.check), ("status", current.status)), 1)
+
+
+def _snapshot() -> dict:
+    with _lock:
+        return {
+            "histograms": [
+                {"name": name, "labels": dict(labels), **hist} for (name, labels), hist in _histograms.items()
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value} for (name, labels), value in _counters.items()
+            ],
+        }
+
+
+def flush() -> None:
+    # Skriv processens värden till en temporär fil och byt namn, läsare ser aldrig en halv fil
+    try:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        path = METRICS_DIR / f"{os.getpid()}_{_token}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(_snapshot()), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        # Mätvärden får aldrig fälla en uppladdning
+        pass
+
+
+def _collect() -> Tuple[Dict[Tuple[str, Labels], dict], Dict[Tuple[str, Labels], float]]:
+    # Summera alla processers filer
+    histograms: Dict[Tuple[str, Labels], dict] = {}
+    counters: Dict[Tuple[str, Labels], float] = {}
+    if not METRICS_DIR.exists():
+        return histograms, counters
+
+    for path in METRICS_DIR.glob("*.json"):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        for h in data.get("histograms", []):
+            key = (h["name"], tuple(sorted(h["labels"].items())))
+            if h["name"] not in BUCKETS or len(h["buckets"]) != len(BUCKETS[h["name"]]):
+                # Filer från en version med andra hinkar hoppas över
+                continue
+            agg = histograms.setdefault(key, {"buckets": [0] * len(BUCKETS[h["name"]]), "sum": 0.0, "count": 0})
+            agg["buckets"] = [a + b for a, b in zip(agg["buckets"], h["buckets"])]
+            agg["sum"] += h["sum"]
+            agg["count"] += h["count"]
+        for c in data.get("counters", []):
+            key = (c["name"], tuple(sorted(c["labels"].items())))
+            counters[key] = counters.get(key, 0) + c["value"]
+    return histograms, counters
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render() -> str:
+    # Prometheus textformat (version 0.0.4)
+    histograms, counters = _collect()
+    lines: List[str] = []
+
+    help_texts = {
+        STAGE_HISTOGRAM: "Tid per steg i en kontroll",
+        MEMORY_HISTOGRAM: "Toppminne per steg (tracemalloc om påslaget, annars processens högsta RSS under steget, bara Linux)",
+        ESTIMATE_HISTOGRAM: "Uppskattat minnesbehov innan inläsning",
+        "check_jobs_total": "Antal jobb per kontroll och utfall",
+        **{f"check_{name}_total": text for name, text in COUNTERS.items()},
+    }
+
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f"# HELP {name} {help_texts.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), hist in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS[name], hist["buckets"]):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_labels(labels, (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels, (('le', '+Inf'),))} {hist['count']}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(hist['sum'])}")
+            lines.append(f"{name}_count{_labels(labels)} {hist['count']}")
+
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# HELP {name} {help_texts.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    return "\n".join(lines) + "\n"
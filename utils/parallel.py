@@ -0,0 +1,52 @@
+"""
+Parallell utvärdering av en kontroll över flera processer.
+
+Ramen delas med en hash av gruppnyckeln (RuleSet.partition_key) så att varje
+grupp hamnar i en partition. Partitionerna utvärderas i en processpool och
+slås ihop med RuleSet.merge, som ger samma avvikelser i samma ordning som en
+seriell körning. Antalet processer styrs av PARALLEL_WORKERS (standard 1,
+dvs. seriellt) eftersom varje uWSGI-process annars startar en egen pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.chunked import partition_of
+from utils.rules import RuleResult, RuleSet
+
+# Mindre exporter vinner inget på att skickas till andra processer
+PARALLEL_MIN_ROWS = 50_000
+
+
+def configured_workers() -> int:
+    return max(1, int(os.environ.get("PARALLEL_WORKERS") or 1))
+
+
+def _evaluate_part(rules: RuleSet, df: pd.DataFrame) -> RuleResult:
+    return rules.evaluate_part(df)
+
+
+def evaluate_parts(df: pd.DataFrame, rules: RuleSet, workers: Optional[int] = None) -> List[RuleResult]:
+    # Delresultat för ramen, ett per process
+    workers = configured_workers() if workers is None else workers
+    if workers <= 1 or len(df) < PARALLEL_MIN_ROWS:
+        return [rules.evaluate_part(df)]
+
+    key = rules.partition_key
+    if key is None:
+        # Bara radregler, sammanhängande block räcker
+        part = np.arange(len(df)) * workers // len(df)
+    else:
+        part = partition_of(df[key], workers)
+
+    pieces = [df[part == p] for p in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_evaluate_part, [rules] * workers, pieces))
+
+
+def evaluate_parallel(df: pd.DataFrame, rules: RuleSet, workers: Optional[int] = None) -> pd.DataFrame:
+    with metrics.stage("evaluate"):
+        return rules.merge(evaluate_parts(df, rules, workers))
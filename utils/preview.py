@@ -0,0 +1,29 @@
+"""
+Förhandsgranskning: antalet avvikelser utan rapport.
+
+Exporten tolkas och utvärderas som i en full körning, men ingen rapport skrivs
+och ingen ögonblicksbild eller jämförelse med förra uppladdningen sparas.
+Tolkningen tar det mesta av tiden. Den tolkade exporten hamnar i den delade
+cachen (utils/dataset_cache.py), så en efterföljande uppladdning av samma fil
+tolkas inte igen.
+"""
+from pathlib import Path
+from typing import Optional, Sequence
+
+from utils import metrics
+from utils.chunked import evaluate_chunked
+from utils.export_utils import read_export
+from utils.rules import RuleSet
+
+
+def count_deviations(rules: RuleSet, input_paths: Sequence[Path], partitions: Optional[int] = None) -> int:
+    # Filerna kontrolleras var för sig, som i utils/check_runner.py
+    deviations = 0
+    for input_path in input_paths:
+        if partitions:
+            deviations += len(evaluate_chunked(input_path, rules, partitions))
+            continue
+        df = read_export(input_path, rules.required)
+        with metrics.stage("evaluate"):
+            deviations += len(rules.evaluate(df))
+    return deviations
@@ -0,0 +1,33 @@
+"""
+Profilering av enskilda uppladdningar, endast för administratörer.
+
+Slås på per anrop med parametern profile=<PROFILE_TOKEN>, eller för alla
+uppladdningar med konfigurationsflaggan PROFILE_ALL_UPLOADS. Profilen sparas
+som en pstats-fil bredvid rapporten och kan öppnas med t.ex. snakeviz eller
+konverteras till flamegraph med flameprof. Är profilering avstängd körs
+process direkt, utan profiler.
+"""
+import cProfile
+import hmac
+from pathlib import Path
+from typing import Callable
+
+from flask import current_app, request
+
+
+def requested() -> bool:
+    # Config-flaggan gäller alla uppladdningar, annars krävs rätt token i anropet
+    if current_app.config.get('PROFILE_ALL_UPLOADS'):
+        return True
+    token = current_app.config.get('PROFILE_TOKEN')
+    supplied = request.values.get('profile')
+    return bool(token) and supplied is not None and hmac.compare_digest(supplied, token)
+
+
+def run_profiled(func: Callable, profile_path: Path, *args):
+    # Profilen skrivs även om func kastar, det är ofta då den behövs
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(str(profile_path))
@@ -0,0 +1,481 @@
+"""
+Deklarativa kontrollregler som kompileras till vektoriserade masker.
+
+En RuleSet beskriver en kontroll: obligatoriska kolumner, härledda kolumner
+(normaliseringar), radregler, gruppregler och orsaksmallar. Predikaten
+beräknas en gång per unikt värde (via kategorikoder) och sprids sedan till
+alla rader, så att nya regler inte kostar en Python-gren per rad.
+"""
+import importlib
+import pickle
+import string
+import sys
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.deviations import DeviationCollector
+from utils.export_utils import category_codes, normalized
+from utils.key_index import KeyIndex
+
+
+def _object_array(values: Sequence) -> np.ndarray:
+    # Endimensionell object-array, även när elementen själva är listor
+    return pd.Series(list(values), dtype=object).to_numpy()
+
+
+class RuleFrame:
+    # Källramen plus cache för normaliserade kolumner, nyckelindex och mellanresultat
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._norm: Dict[str, pd.Series] = {}
+        self._index: Dict[str, KeyIndex] = {}
+        self._memo: Dict[str, object] = {}
+        self._keywords: Dict[Tuple[str, str], np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def __getitem__(self, col: str) -> pd.Series:
+        return self.df[col]
+
+    def norm(self, col: str) -> pd.Series:
+        # strip/lower en gång per kolumn och unikt värde
+        if col not in self._norm:
+            self._norm[col] = normalized(self.df[col])
+        return self._norm[col]
+
+    def index(self, key: str) -> KeyIndex:
+        if key not in self._index:
+            self._index[key] = KeyIndex(self.df[key])
+        return self._index[key]
+
+    def memo(self, name: str, fn: Callable[[], object]):
+        # Delade mellanresultat mellan regler, t.ex. aggregat per grupp
+        if name not in self._memo:
+            self._memo[name] = fn()
+        return self._memo[name]
+
+    def per_value(self, col: str, func: Callable, norm: bool = True) -> np.ndarray:
+        # Kör func en gång per unikt (normaliserat) värde och sprid till raderna
+        series = self.norm(col) if norm else self.df[col]
+        codes, uniques = category_codes(series)
+        missing = "" if norm else np.nan
+        return _object_array([func(u) for u in uniques] + [func(missing)])[codes]
+
+    def keywords(self, col: str, words: Sequence[str]) -> Dict[str, np.ndarray]:
+        # Om det normaliserade värdet innehåller respektive ord: alla ord i ett svep per unikt
+        # värde, spritt till raderna som booleska arrayer. Varje kolumn och ord beräknas en gång
+        todo = [w for w in dict.fromkeys(words) if (col, w) not in self._keywords]
+        if todo:
+            codes, uniques = category_codes(self.norm(col))
+            rows = [[w in u for w in todo] for u in uniques] + [[w in "" for w in todo]]
+            table = np.array(rows, dtype=bool)
+            for i, w in enumerate(todo):
+                self._keywords[(col, w)] = table[codes, i]
+        return {w: self._keywords[(col, w)] for w in words}
+
+    def per_combination(self, cols: Sequence[str], func: Callable) -> np.ndarray:
+        # Kör func en gång per unik kombination av råvärden i cols
+        combined = np.zeros(len(self.df), dtype=np.int64)
+        for col in cols:
+            codes, uniques = category_codes(self.df[col])
+            combined, _ = pd.factorize(combined * (len(uniques) + 1) + (codes + 1))
+
+        # En representativ rad per kombination ger värdena som func får
+        _, first = np.unique(combined, return_index=True)
+        args = [self.df[col].to_numpy(dtype=object)[first] for col in cols]
+
+        return _object_array([func(*vals) for vals in zip(*args)])[combined]
+
+    def text(self, col: str, positions: np.ndarray) -> np.ndarray:
+        # Kolumnens värden som text (som i en f-sträng) för valda rader, formaterat per unikt värde
+        codes, uniques = category_codes(self.df[col])
+        texts = np.array([str(u) for u in uniques] + ["nan"], dtype=object)
+        return texts[codes[positions]]
+
+
+class Predicate:
+    # Radpredikat som kan kombineras med &, | och ~
+
+    def __init__(self, fn: Callable[[RuleFrame], np.ndarray]):
+        self._fn = fn
+
+    def mask(self, frame: RuleFrame) -> np.ndarray:
+        return np.asarray(self._fn(frame), dtype=bool)
+
+    def __and__(self, other: "Predicate") -> "Predicate":
+        return Predicate(lambda f: self.mask(f) & other.mask(f))
+
+    def __or__(self, other: "Predicate") -> "Predicate":
+        return Predicate(lambda f: self.mask(f) | other.mask(f))
+
+    def __invert__(self) -> "Predicate":
+        return Predicate(lambda f: ~self.mask(f))
+
+
+def where(fn: Callable[[RuleFrame], np.ndarray]) -> Predicate:
+    return Predicate(fn)
+
+
+def column(col: str) -> Predicate:
+    # Boolesk (härledd) kolumn
+    return Predicate(lambda f: f[col].to_numpy(dtype=bool))
+
+
+def missing(col: str) -> Predicate:
+    return Predicate(lambda f: f[col].isna().to_numpy())
+
+
+def blank(col: str) -> Predicate:
+    # Saknat värde eller bara blanksteg
+    return Predicate(lambda f: (f.norm(col) == "").to_numpy())
+
+
+def equals(col: str, value: str) -> Predicate:
+    # Jämförelse mot normaliserat (strip/lower) värde
+    value = value.strip().lower()
+    return Predicate(lambda f: (f.norm(col) == value).to_numpy())
+
+
+def isin(col: str, values: Iterable[str]) -> Predicate:
+    values = {v.strip().lower() for v in values}
+    return Predicate(lambda f: f.norm(col).isin(values).to_numpy())
+
+
+def startswith(col: str, prefix: str) -> Predicate:
+    return Predicate(lambda f: f.per_value(col, lambda v: v.startswith(prefix)))
+
+
+def differs(col_a: str, col_b: str) -> Predicate:
+    # Normaliserade värden skiljer sig åt
+    return Predicate(
+        lambda f: f.norm(col_a).to_numpy(dtype=object) != f.norm(col_b).to_numpy(dtype=object)
+    )
+
+
+def combination(cols: Sequence[str], func: Callable[..., bool]) -> Predicate:
+    # Godtyckligt villkor över flera kolumner, utvärderat en gång per unik värdekombination
+    return Predicate(lambda f: f.per_combination(cols, func))
+
+
+class RowRule:
+    """
+    Radregel: rader där when är sann blir avvikelser med orsaken reason.
+    reason är en mall där {Kolumn} ersätts med radens värde. values mappar
+    utdatakolumner till (härledda) kolumner i källramen.
+    """
+
+    def __init__(self, when: Predicate, reason: str = "", values: Optional[Dict[str, str]] = None):
+        self.when = when
+        self.reason = reason
+        self.values = values or {}
+
+    def evaluate(self, frame: RuleFrame, separator: str):
+        positions = np.flatnonzero(self.when.mask(frame))
+        return positions, format_reason(self.reason, frame, positions)
+
+
+class TextRule:
+    """
+    Regel vars orsaker beror på texten i flera kolumner. func får kolumnernas
+    råvärden och returnerar en lista med orsaker (tom lista = ingen avvikelse).
+    Den körs en gång per unik kombination av värden.
+    """
+
+    def __init__(self, columns: Sequence[str], func: Callable[..., List[str]]):
+        self.columns = list(columns)
+        self.func = func
+        self.values: Dict[str, str] = {}
+
+    def evaluate(self, frame: RuleFrame, separator: str):
+        joined = frame.per_combination(self.columns, lambda *vals: separator.join(self.func(*vals)))
+        positions = np.flatnonzero(joined != "")
+        return positions, joined[positions]
+
+
+class GroupRule:
+    """
+    Gruppregel per nyckel (t.ex. Flextjänstnr). when returnerar en boolesk
+    array per grupp. Avvikande grupper rapporteras med gruppens första rad,
+    nyckeln och values, som beräknas bara för de avvikande grupperna.
+    values-nycklar som inte är utdatakolumner kan användas i orsaksmallen.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        when: Callable[[RuleFrame, KeyIndex], np.ndarray],
+        reason: str = "",
+        values: Optional[Dict[str, Callable[[RuleFrame, KeyIndex, np.ndarray], Sequence]]] = None,
+    ):
+        self.key = key
+        self.when = when
+        self.reason = reason
+        self.values = values or {}
+
+
+def format_reason(template: str, frame: RuleFrame, positions: np.ndarray,
+                  values: Optional[Dict[str, Sequence]] = None) -> np.ndarray:
+    # Fyll i mallen för valda rader, fält hämtas från values i första hand och annars från källramen
+    out = np.full(len(positions), "", dtype=object)
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            out = out + literal
+        if field is None:
+            continue
+        if values and field in values:
+            texts = np.array([str(v) for v in values[field]], dtype=object)
+        else:
+            texts = frame.text(field, positions)
+        out = out + texts
+    return out
+
+
+class RuleResult:
+    """
+    Avvikelser för en del av exporten (hela filen, en batch eller en partition).
+    rows och groups har källans radetiketter som index. row_keys, group_keys och
+    group_rules bestämmer ordningen när delresultat slås ihop med RuleSet.merge.
+    """
+
+    def __init__(self, rows: pd.DataFrame, row_keys: Optional[np.ndarray],
+                 groups: pd.DataFrame, group_keys: np.ndarray, group_rules: np.ndarray, n_groups: int = 0):
+        self.rows = rows
+        self.row_keys = row_keys
+        self.groups = groups
+        self.group_keys = group_keys
+        self.group_rules = group_rules
+        self.n_groups = n_groups
+
+    @classmethod
+    def concat(cls, results: Sequence["RuleResult"]) -> "RuleResult":
+        # Ett delresultat av flera, utan att sortera (det gör RuleSet.merge)
+        rows = [r.rows for r in results if len(r.rows)] or [results[0].rows]
+        groups = [r.groups for r in results if len(r.groups)] or [results[0].groups]
+        row_keys = None if results[0].row_keys is None else np.concatenate([r.row_keys for r in results])
+        return cls(
+            _concat(rows), row_keys, _concat(groups),
+            np.concatenate([r.group_keys for r in results]),
+            np.concatenate([r.group_rules for r in results]),
+            sum(r.n_groups for r in results),
+        )
+
+
+class RuleSet:
+    """
+    En kontroll uttryckt som regler.
+
+    columns     utdatakolumner i ordning
+    required    obligatoriska kolumner i exporten
+    derived     härledda kolumner (normaliseringar, tolkade frekvenser m.m.)
+                som beräknas en gång innan reglerna körs
+    rules       radregler (RowRule/TextRule), orsaker för samma rad slås ihop
+                med separator i regelordning, och gruppregler (GroupRule)
+    include     rader som ingår i kontrollen, övriga tas bort innan derived
+    skip        rader som inte omfattas av radreglerna
+    order_by    nyckel som radavvikelserna sorteras efter (som vid groupby)
+    identity    utdatakolumner som tillsammans med Orsak känner igen samma
+                avvikelse mellan körningar (standard: alla utom Orsak)
+
+    Gruppregler och order_by får tillsammans använda högst en nyckel, och härledda
+    kolumner som grupperar ska använda samma nyckel. Då är varje grupp helt
+    inom en partition (partition_key) och exporten kan utvärderas i delar.
+    """
+
+    def __init__(
+        self,
+        columns: Sequence[str],
+        required: Set[str],
+        rules: Sequence,
+        derived: Optional[Dict[str, Callable[[RuleFrame], Sequence]]] = None,
+        include: Optional[Predicate] = None,
+        skip: Optional[Predicate] = None,
+        order_by: Optional[str] = None,
+        identity: Optional[Sequence[str]] = None,
+        separator: str = "; ",
+    ):
+        self.columns = list(columns)
+        self.required = set(required)
+        self.rules = list(rules)
+        self.derived = derived or {}
+        self.include = include
+        self.skip = skip
+        self.order_by = order_by
+        self.identity = list(identity) if identity is not None else [c for c in self.columns if c != "Orsak"]
+        self.separator = separator
+        # Modulen som definierar reglerna, för att kunna skicka dem till andra processer
+        self.module = sys._getframe(1).f_globals.get("__name__")
+
+    def __reduce__(self):
+        # Reglerna innehåller lambdas och picklas därför som en referens till sin modul
+        module = sys.modules.get(self.module)
+        names = [name for name, value in vars(module).items() if value is self] if module else []
+        if not names:
+            raise pickle.PicklingError("RuleSet kan bara skickas mellan processer om den är definierad på modulnivå")
+        return _module_rules, (self.module, names[0])
+
+    @property
+    def group_keys(self) -> Set[str]:
+        return {r.key for r in self.rules if isinstance(r, GroupRule)}
+
+    @property
+    def partition_key(self) -> Optional[str]:
+        # Nyckeln som exporten måste delas upp på, None om alla regler är radregler
+        keys = self.group_keys | ({self.order_by} if self.order_by is not None else set())
+        if len(keys) > 1:
+            raise ValueError(f"Reglerna grupperar på flera nycklar ({', '.join(sorted(keys))}) och kan inte delas upp")
+        return next(iter(keys), None)
+
+    def included(self, df: pd.DataFrame) -> np.ndarray:
+        if self.include is None:
+            return np.ones(len(df), dtype=bool)
+        return self.include.mask(RuleFrame(df))
+
+    def prepare(self, df: pd.DataFrame) -> RuleFrame:
+        if self.include is not None:
+            df = df[self.included(df)].copy()
+        frame = RuleFrame(df)
+        for name, fn in self.derived.items():
+            df[name] = fn(frame)
+        return frame
+
+    def evaluate(self, df: pd.DataFrame) -> pd.DataFrame:
+        with metrics.stage("evaluate"):
+            return self.merge([self.evaluate_part(df)])
+
+    def evaluate_part(self, df: pd.DataFrame) -> RuleResult:
+        # Delresultat för en del av exporten som innehåller hela grupper
+        frame = self.prepare(df)
+        rows, row_keys = self._evaluate_rows(frame)
+        groups, group_keys, group_rules = self._evaluate_groups(frame)
+        n_groups = sum(frame.index(key).n_groups for key in self.group_keys)
+        return RuleResult(rows, row_keys, groups, group_keys, group_rules, n_groups)
+
+    def merge(self, results: Sequence[RuleResult]) -> pd.DataFrame:
+        """
+        Slår ihop delresultat i samma ordning som om hela exporten utvärderats på
+        en gång: radavvikelser i radordning (per order_by-nyckel om den finns),
+        därefter gruppavvikelser per nyckel och regel.
+        """
+        collector = DeviationCollector(self.columns)
+        metrics.count("groups", sum(r.n_groups for r in results))
+
+        parts = [r for r in results if len(r.rows)]
+        if parts:
+            rows = _concat([r.rows for r in parts])
+            labels = rows.index.to_numpy()
+            if self.order_by is not None:
+                codes = _sort_codes(np.concatenate([r.row_keys for r in parts]))
+                order = np.lexsort((labels, codes))
+            else:
+                order = np.argsort(labels, kind="stable")
+            collector.add_frame(rows.iloc[order])
+
+        parts = [r for r in results if len(r.groups)]
+        if parts:
+            groups = _concat([r.groups for r in parts])
+            codes = _sort_codes(np.concatenate([r.group_keys for r in parts]))
+            order = np.lexsort((np.concatenate([r.group_rules for r in parts]), codes))
+            collector.add_frame(groups.iloc[order])
+
+        return collector.to_frame()
+
+    def _evaluate_rows(self, frame: RuleFrame):
+        collector = DeviationCollector(self.columns)
+        row_rules = [r for r in self.rules if not isinstance(r, GroupRule)]
+        if not row_rules:
+            return collector.to_frame(), None
+
+        n = len(frame)
+        keep = ~self.skip.mask(frame) if self.skip is not None else np.ones(n, dtype=bool)
+        reasons = np.full(n, "", dtype=object)
+        extras: Dict[str, np.ndarray] = {}
+
+        for rule in row_rules:
+            positions, texts = rule.evaluate(frame, self.separator)
+            hit = keep[positions]
+            positions, texts = positions[hit], texts[hit]
+            if len(positions) == 0:
+                continue
+
+            # Slå ihop med orsaker från tidigare regler för samma rad
+            prev = reasons[positions]
+            reasons[positions] = np.where(prev == "", texts, prev + self.separator + texts)
+
+            for out_col, src_col in rule.values.items():
+                if out_col not in extras:
+                    extras[out_col] = np.full(n, None, dtype=object)
+                extras[out_col][positions] = frame[src_col].to_numpy(dtype=object)[positions]
+
+        rows = np.flatnonzero(reasons != "")
+        if self.order_by is not None:
+            rows = rows[frame.index(self.order_by).order(rows)]
+
+        values = {col: arr[rows] for col, arr in extras.items()}
+        if "Orsak" in self.columns:
+            values["Orsak"] = reasons[rows]
+        collector.add_rows(frame.df, rows, values)
+
+        row_keys = frame[self.order_by].to_numpy(dtype=object)[rows] if self.order_by is not None else None
+        return collector.to_frame(), row_keys
+
+    def _evaluate_groups(self, frame: RuleFrame):
+        collector = DeviationCollector(self.columns)
+        parts = []
+        for rule_no, rule in enumerate(self.rules):
+            if not isinstance(rule, GroupRule):
+                continue
+            index = frame.index(rule.key)
+            groups = np.flatnonzero(rule.when(frame, index))
+            first = index.first()[groups]
+
+            values = {name: fn(frame, index, groups) for name, fn in rule.values.items()}
+            out = {col: val for col, val in values.items() if col in self.columns}
+            out[rule.key] = index.keys[groups]
+            if rule.reason and "Orsak" in self.columns:
+                out["Orsak"] = format_reason(rule.reason, frame, first, values)
+            keys = _object_array(index.keys[groups])
+            parts.append((np.full(len(groups), rule_no), first, out, keys))
+
+        if not parts:
+            return collector.to_frame(), np.empty(0, dtype=object), np.empty(0, dtype=int)
+
+        # Avvikelser från flera regler läggs efter varandra, merge sorterar dem per grupp
+        if len(parts) > 1:
+            first = np.concatenate([f for _, f, _, _ in parts])
+            out = {}
+            for col in dict.fromkeys(c for _, _, o, _ in parts for c in o):
+                # Kolumner som en regel inte sätter hämtas från gruppens första rad
+                out[col] = np.concatenate([
+                    _object_array(o[col]) if col in o else self._source_values(frame, col, f)
+                    for _, f, o, _ in parts
+                ])
+            parts = [(np.concatenate([r for r, _, _, _ in parts]), first, out,
+                      np.concatenate([k for _, _, _, k in parts]))]
+
+        rule_nos, first, out, keys = parts[0]
+        collector.add_rows(frame.df, first, out)
+        return collector.to_frame(), keys, rule_nos
+
+    @staticmethod
+    def _source_values(frame: RuleFrame, col: str, positions: np.ndarray) -> np.ndarray:
+        if col in frame.df.columns:
+            return frame[col].to_numpy(dtype=object)[positions]
+        return np.full(len(positions), None, dtype=object)
+
+
+def _module_rules(module: str, name: str) -> "RuleSet":
+    return getattr(importlib.import_module(module), name)
+
+
+def _concat(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+
+def _sort_codes(keys: np.ndarray) -> np.ndarray:
+    # Nyckelvärdenas ordning som i groupby (saknade värden först), samma för varje uppdelning
+    codes, _ = pd.factorize(_object_array(keys), sort=True)
+    return codes
@@ -0,0 +1,116 @@
+from typing import Callable, List, Optional, Sequence
+
+from flask import current_app, request, flash, redirect, url_for, session
+from werkzeug.datastructures import FileStorage
+from utils import memory, metrics, profiling
+from utils.preview import count_deviations
+from utils.rules import RuleSet
+from utils.file_utils import allowed_file, cleanup_folder, new_session_id, save_upload, UPLOAD_FOLDER
+
+
+def _uploaded_files(fields: Sequence[str]) -> Optional[List[List[FileStorage]]]:
+    # Filerna per fält, None (efter ett flash-meddelande) om något fält saknar giltiga filer
+    uploads = []
+    for field in fields:
+        if field not in request.files:
+            flash('Ingen fil i anropet')
+            return None
+
+        files = [file for file in request.files.getlist(field) if file.filename != '']
+        if not files:
+            flash('Du måste välja en fil' if len(fields) == 1 else 'Du måste välja en fil för varje export')
+            return None
+
+        if not all(allowed_file(file.filename) for file in files):
+            flash('Endast Excel-filer (.xlsx) eller zip-arkiv med Excel-filer tillåtna')
+            return None
+        uploads.append(files)
+    return uploads
+
+
+def handle_upload(check: str, process: Callable[..., int], output_prefix: str, message: str,
+                  fields: Sequence[str] = ('file',), rules: Optional[RuleSet] = None):
+    """
+    Gemensamt flöde för uppladdningsendpoints: validera filerna, spara dem, kör
+    process (i delar om filen inte ryms i minnesbudgeten) och lägg resultatet
+    i sessionen för success-sidan. message formateras med antalet avvikelser
+    ({deviations}) när det finns avvikelser.
+
+    fields är formulärfälten med filer. process anropas med en sökväg per fält,
+    sökvägen till rapporten och antalet partitioner (None om filerna ryms).
+    Kontroller med ett fält tar emot flera filer eller zip-arkiv och får då en
+    lista med sökvägar, som kontrolleras var för sig och slås ihop till en rapport.
+
+    Med rules kan kontrollen förhandsgranskas (preview=1 i adressen): antalet
+    avvikelser visas på startsidan utan att någon rapport skrivs.
+    """
+    uploads = _uploaded_files(fields)
+    if uploads is None:
+        return redirect(url_for('index'))
+    cleanup_folder()
+    session_id = new_session_id()
+    preview = rules is not None and request.args.get('preview') == '1'
+
+    output_filename = f"{output_prefix}_{session_id}.xlsx"
+    output_path = UPLOAD_FOLDER / output_filename
+    profile_filename = f"profil_{output_prefix}_{session_id}.pstats" if profiling.requested() and not preview else None
+
+    with metrics.job(f"{check}_preview" if preview else check) as job:
+        try:
+            with metrics.stage("save"):
+                field_paths = [[path for file in files for path in save_upload(file, session_id)]
+                               for files in uploads]
+
+            if len(fields) > 1 and any(len(paths) > 1 for paths in field_paths):
+                raise ValueError('Välj en fil per export')
+            input_paths = [path for paths in field_paths for path in paths]
+
+            # Jobb som beräknas överskrida minnesbudgeten körs i delar
+            partitions = None
+            with metrics.stage("estimate"):
+                try:
+                    job.estimated_memory = memory.check_budget(input_paths, current_app.config.get('MEMORY_BUDGET_MB'))
+                except memory.MemoryBudgetExceeded as e:
+                    job.estimated_memory = e.estimate
+                    partitions = memory.partitions_for(e.estimate, e.budget)
+                    metrics.count("chunked", 1)
+
+            # En fil per fält skickas som sökväg, flera som lista
+            args = [paths[0] if len(paths) == 1 else paths for paths in field_paths]
+            if preview:
+                deviations = count_deviations(rules, input_paths, partitions)
+            elif profile_filename:
+                deviations = profiling.run_profiled(
+                    process, UPLOAD_FOLDER / profile_filename, *args, output_path, partitions)
+            else:
+                deviations = process(*args, output_path, partitions)
+        except ValueError as e:
+            job.status = "rejected"
+            flash(str(e))
+            return redirect(url_for('index'))
+        except Exception:
+            job.status = "error"
+            flash('Fel vid bearbetning av filen')
+            return redirect(url_for('index'))
+
+        metrics.count("deviations", deviations)
+
+    if preview:
+        flash(f'Förhandsgranskning: {deviations} avvikelser hittades. Skicka filen för att få rapporten.', 'info')
+        return redirect(url_for('index'))
+
+    if deviations > 0:
+        message = message.format(deviations=deviations)
+    else:
+        message = "Inga avvikelser hittades."
+
+    session_key = f"result_{session_id}"
+    session[session_key] = {
+        "deviations": deviations,
+        "output_filename": output_filename,
+        "back": "index",
+        "message": message,
+        "profile_filename": profile_filename
+    }
+
+    return redirect(url_for('success', file=session_id))
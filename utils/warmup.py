@@ -0,0 +1,82 @@
+"""
+Uppvärmning av appen innan uWSGI forkar sina workers.
+
+pandas läser och skriver Excel via openpyxl och xlsxwriter som importeras
+först vid första användningen, och mallar, frekvenstabeller och pandas egna
+kodvägar laddas också vid första anropet. Utan uppvärmning betalar den första
+uppladdningen i varje ny worker för det. warm_up gör allt detta en gång i
+mastern, så att workerna ärver det färdigt via fork (se wsgi.py).
+"""
+import io
+import logging
+import os
+import sys
+import time
+from typing import Dict
+
+import pandas as pd
+from flask import Flask
+
+from utils.export_utils import prepare_export, write_deviations
+from utils.frequency import FREQ_PER_WEEK, expected_count, freq_per_week
+
+logger = logging.getLogger(__name__)
+
+
+def enabled() -> bool:
+    return os.environ.get("WARMUP", "1") != "0"
+
+
+def _excel_roundtrip() -> None:
+    # Skriv och läs en liten arbetsbok så att Excel-motorerna och deras beroenden laddas
+    buffer = io.BytesIO()
+    write_deviations(pd.DataFrame({"Orsak": ["uppvärmning"]}), buffer)
+    buffer.seek(0)
+    pd.read_excel(buffer)
+
+
+def _frequency_tables() -> None:
+    for text in FREQ_PER_WEEK:
+        freq_per_week(text)
+        expected_count(text)
+
+
+def _templates(app: Flask) -> None:
+    # Jinja kompilerar mallarna vid första renderingen, get_template lägger dem i cachen
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def _checks(app: Flask) -> None:
+    # Kör varje kontrolls regler på en tom rad, det laddar regelmotorns och pandas kodvägar
+    for blueprint in app.blueprints.values():
+        rules = getattr(sys.modules.get(blueprint.import_name), "RULES", None)
+        if rules is None:
+            continue
+        blank = pd.DataFrame({col: pd.Series([None], dtype=object) for col in sorted(rules.required)})
+        try:
+            rules.evaluate(prepare_export(blank, rules.required))
+        except Exception as e:
+            # Kontroller som behöver mer än exportens kolumner (t.ex. en join) värms inte här
+            logger.debug("Uppvärmning av %s hoppades över: %r", blueprint.name, e)
+
+
+def warm_up(app: Flask) -> Dict[str, float]:
+    """
+    Laddar tunga moduler, mallar och cacher i den här processen. Returnerar
+    tiden per steg i sekunder. Avstängt med WARMUP=0.
+    """
+    timings: Dict[str, float] = {}
+    if not enabled():
+        return timings
+    for name, step in (
+        ("excel", _excel_roundtrip),
+        ("frequency", _frequency_tables),
+        ("templates", lambda: _templates(app)),
+        ("checks", lambda: _checks(app)),
+    ):
+        start = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - start
+    logger.info("Uppvärmning klar på %.2f s", sum(timings.values()))
+    return timings
@@ -0,0 +1,96 @@
+"""
+Exporter i arbetsböcker med flera blad.
+
+Konsoliderade exporter kan ha ett blad per affärsenhet med samma kolumner.
+De (namngivna) kolumner som flest blad har är exportens, och bladen med just
+de kolumnerna räknas som delar av den. Övriga blad, t.ex. sammanställningar,
+hoppas över. Bladen tolkas parallellt i en processpool och slås ihop i
+bladordning.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Sequence
+
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.workbook.workbook import Workbook
+
+logger = logging.getLogger(__name__)
+
+
+def sheet_workers() -> int:
+    # Processer som tolkar bladen, som standard lika många som för gruppkontrollerna (utils/parallel.py).
+    # Läses vid varje anrop så att processer i en pool kan sätta den till 1 (check_runner._serial_worker)
+    return max(1, int(os.environ.get("SHEET_WORKERS") or os.environ.get("PARALLEL_WORKERS") or 1))
+
+
+def column_names(header: Sequence) -> List[str]:
+    # Kolumnnamn som i pd.read_excel: tomma rubriker blir "Unnamed: n", dubbletter får suffix
+    names, seen = [], {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _named(header: Sequence) -> frozenset:
+    # Bladets namngivna kolumner, tomma rubriker (t.ex. formaterade men tomma kolumner) räknas inte
+    return frozenset(name for name, value in zip(column_names(header), header) if value is not None)
+
+
+def export_sheets(wb: Workbook) -> list:
+    """
+    Bladen i en skrivskyddat öppnad arbetsbok som hör till exporten, i
+    bladordning. Utan något blad med rubrikrad returneras det första bladet.
+    """
+    named = [(ws, _named(next(ws.iter_rows(max_row=1, values_only=True), ()))) for ws in wb.worksheets]
+    with_header = [(ws, cols) for ws, cols in named if cols]
+    if not with_header:
+        return wb.worksheets[:1]
+
+    # Kolumnerna som flest blad har, vid lika antal det första bladets
+    schemas = [cols for _, cols in with_header]
+    reference = max(schemas, key=schemas.count)
+    skipped = [ws.title for ws, cols in with_header if cols != reference]
+    if skipped:
+        logger.info("Blad med andra kolumner än exporten hoppas över: %s", ", ".join(skipped))
+    return [ws for ws, cols in with_header if cols == reference]
+
+
+def _read_sheet(input_path: Path, sheet: str) -> pd.DataFrame:
+    return pd.read_excel(input_path, sheet_name=sheet)
+
+
+def read_workbook(input_path: Path) -> pd.DataFrame:
+    """
+    Exportens blad som en ram, med löpande radindex. Ett blad läses som
+    vanligt, flera tolkas i upp till sheet_workers() processer.
+    """
+    wb = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        sheets = [ws.title for ws in export_sheets(wb)]
+    finally:
+        wb.close()
+
+    if len(sheets) == 1:
+        return _read_sheet(input_path, sheets[0])
+
+    workers = min(sheet_workers(), len(sheets))
+    if workers <= 1:
+        frames = [_read_sheet(input_path, sheet) for sheet in sheets]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(_read_sheet, [input_path] * len(sheets), sheets))
+
+    # Kolumnerna ställs upp efter namn i det första bladets ordning. Varje kolumn kopieras
+    # en gång in i den sammanslagna ramen, bladens egna ramar släpps direkt efteråt
+    df = pd.concat(frames, ignore_index=True)
+    del frames
+    return df
@@ -0,0 +1,133 @@
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+from flask import Blueprint
+from utils import export_store, metrics
+from utils.deviation_diff import compare_with_previous
+from utils.export_utils import export_scope, read_export, write_deviations
+from utils.join import join_exports
+from utils.key_index import KeyIndex
+from utils.parallel import evaluate_parallel
+from utils.rules import GroupRule, RuleFrame, RuleSet
+from utils.upload_utils import handle_upload
+from views.hamtfrekvens_prisdel import hamt_in_prisdel
+
+bp = Blueprint('avtal_tjanst_check', __name__)
+
+
+# Flextjänsterna i tjänsteexporten matchas mot avtalsexportens rader på dessa nycklar
+JOIN_KEYS = ["Kundnummer", "Flextjänst"]
+
+SERVICE_REQUIRED = {
+    'Affärsenhet',
+    'Kundnummer',
+    'Flextjänst',
+    'Flexplatsadress',
+    'Hämtfrekvens',
+}
+
+CONTRACT_REQUIRED = {
+    'Kundnummer',
+    'Flextjänst',
+    'Avtalsnummer',
+    'Prisdel',
+    'Debiteringsgrupp',
+}
+
+
+def _without_contract(f: RuleFrame, index: KeyIndex) -> np.ndarray:
+    # Flextjänster utan någon rad i avtalsexporten
+    return ~index.any(f['_avtal_finns'].to_numpy())
+
+
+def _freq_not_in_prisdel(f: RuleFrame, index: KeyIndex) -> np.ndarray:
+    # Hämtfrekvensen finns inte i någon av avtalets prisdelar för flextjänsten
+    found = f['_avtal_finns'].to_numpy()
+    return index.any(found) & ~index.any(found & f['_prisdel_ok'].to_numpy())
+
+
+def _distinct_text(col: str):
+    def values(f: RuleFrame, index: KeyIndex, groups: np.ndarray) -> list:
+        return [", ".join(sorted(set(map(str, vals)))) for vals in index.distinct(f[col], groups)]
+    return values
+
+
+# Reglerna körs på de sammanslagna exporterna, en rad per matchande par (tjänst, avtalsrad)
+RULES = RuleSet(
+    columns=[
+        "Affärsenhet",
+        "Kundnummer",
+        "Flextjänst",
+        "Flexplatsadress",
+        "Hämtfrekvens",
+        "Avtalsnummer",
+        "Prisdel",
+        "Debiteringsgrupp",
+        "Orsak",
+    ],
+    required=SERVICE_REQUIRED | CONTRACT_REQUIRED,
+    derived={
+        '_avtal_finns': lambda f: f['_högerrad'].to_numpy() >= 0,
+        '_prisdel_ok': lambda f: f.per_combination(['Hämtfrekvens', 'Prisdel'], hamt_in_prisdel).astype(bool),
+    },
+    rules=[
+        # Grupperna är tjänsteexportens rader, så att en flextjänst med flera avtalsrader bedöms en gång
+        GroupRule(
+            '_vänsterrad',
+            _without_contract,
+            "Flextjänsten saknas i avtalsexporten",
+        ),
+        GroupRule(
+            '_vänsterrad',
+            _freq_not_in_prisdel,
+            "Hämtfrekvens '{Hämtfrekvens}' finns inte i någon prisdel på avtalet",
+            values={
+                "Avtalsnummer": _distinct_text('Avtalsnummer'),
+                "Prisdel": _distinct_text('Prisdel'),
+            },
+        ),
+    ],
+    identity=["Kundnummer", "Flextjänst"],
+)
+
+
+def check_avtal_tjanst(services: pd.DataFrame, contracts: pd.DataFrame) -> pd.DataFrame:
+    with metrics.stage("join"):
+        joined = join_exports(services, contracts, JOIN_KEYS)
+    return evaluate_parallel(joined, RULES)
+
+
+def process_avtal_tjanst(service_path: Path, contract_path: Path, output_path: Path,
+                         partitions: Optional[int] = None) -> int:
+
+    if partitions:
+        # Båda exporterna måste finnas i minnet samtidigt för att kunna matchas
+        raise ValueError("Exporterna är för stora för att jämföras inom minnesbudgeten")
+
+    services = read_export(service_path, SERVICE_REQUIRED)
+    contracts = read_export(contract_path, CONTRACT_REQUIRED)
+    out_df = check_avtal_tjanst(services, contracts)
+
+    # Nya, åtgärdade och kvarstående avvikelser sedan förra körningen
+    sheets = compare_with_previous("avtal_tjanst", out_df, RULES, export_scope(services))
+
+    export_store.append("avtal_tjanst", service_path, None, out_df)
+
+    # Skriv resultat till Excel
+    write_deviations(out_df, output_path, sheets=sheets)
+
+    return len(out_df)
+
+
+# Endpoint för uppladdning av tjänste- och avtalsexporten
+@bp.route('/upload/avtal_tjanst_check', methods=['POST'])
+def avtal_tjanst_upload():
+    return handle_upload(
+        "avtal_tjanst",
+        process_avtal_tjanst,
+        "avvikelser_avtal_tjanst",
+        "{deviations} flextjänster saknar avtal eller har en hämtfrekvens som inte finns i avtalets prisdelar",
+        fields=('tjanster', 'avtal'),
+    )
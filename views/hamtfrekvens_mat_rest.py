@@ -1,18 +1,63 @@
+import logging
 from pathlib import Path
-from typing import List
+from typing import Optional
+import numpy as np
 import pandas as pd
 
-from flask import Blueprint, request, flash, redirect, url_for, session
-from utils.file_utils import allowed_file, create_session_paths, cleanup_folder, UPLOAD_FOLDER
+from flask import Blueprint
+from utils.check_runner import run_check
+from utils.export_utils import map_categories
+from utils.frequency import freq_per_week, map_frequencies, unknown_frequencies
+from utils.incremental import evaluate_incremental
+from utils.key_index import KeyIndex
+from utils.parallel import evaluate_parallel
+from utils.rules import GroupRule, RuleFrame, RuleSet, where
+from utils.upload_utils import handle_upload
 
 bp = Blueprint('hamtfrekvens_mat_rest', __name__)
+logger = logging.getLogger(__name__)
 
-def process_hamtfrekvens(input_path: Path, output_path: Path) -> int:
 
-    df = pd.read_excel(input_path)
+# Fraktioner som räknas som en annan fraktion
+FRAKTION_MAP = {'Restavfall nollvision': 'Restavfall'}
 
-    # Kontrollera obligatoriska kolumner
-    required_cols = {
+
+def _fraktion_norm(f: RuleFrame) -> pd.Series:
+    return map_categories(f['Fraktion'], lambda x: FRAKTION_MAP.get(x, x))
+
+
+def _is_mat(f: RuleFrame) -> np.ndarray:
+    return (f['Fraktion_norm'] == 'Matavfall').to_numpy()
+
+
+def _mat_over_rest(f: RuleFrame, index: KeyIndex) -> np.ndarray:
+    # Flexplatser som saknar en fraktion eller tolkbara frekvenser har NaN och hoppas över.
+    # Skriv ut endast om mat har högre max-frekvens än rest
+    freq = f['freq_num'].to_numpy()
+    is_mat = _is_mat(f)
+    return index.max(freq, is_mat) > index.max(freq, ~is_mat)
+
+
+def _listed(col: str, mat: bool):
+    # Sorterade unika värden som text per avvikande flexplats och fraktion
+    def values(f: RuleFrame, index: KeyIndex, groups: np.ndarray) -> list:
+        found = index.distinct(f[col], groups, mask=_is_mat(f) == mat, dropna=False)
+        return [sorted(set(map(str, vals))) for vals in found]
+    return values
+
+
+RULES = RuleSet(
+    columns=[
+        "Affärsenhet",
+        "Kundnummer",
+        "Flexplats",
+        "Flexplatsadress",
+        "Matavfall hämtfrekvenser",
+        "Restavfall hämtfrekvenser",
+        "Matavfall flextjänster",
+        "Restavfall flextjänster",
+    ],
+    required={
         'Affärsenhet',
         'Kundnummer',
         'Flexplats',
@@ -20,133 +65,54 @@ def process_hamtfrekvens(input_path: Path, output_path: Path) -> int:
         'Fraktion',
         'Hämtfrekvens',
         'Flextjänst'
-    }
-    missing = required_cols - set(df.columns)
-    if missing:
-        raise ValueError(f"Saknar kolumner: {', '.join(missing)}")
-
-    # Normalisera fraktion och filtrera på Matavfall/Restavfall
-    df['Fraktion'] = df['Fraktion'].fillna('')
-    df['Fraktion_norm'] = df['Fraktion'].replace({'Restavfall nollvision': 'Restavfall'})
-    df = df[df['Fraktion_norm'].isin(['Matavfall', 'Restavfall'])].copy()
-
-    # Mappa text till numeriskt värde (hämtningar per vecka)
-    freq_map = {
-        'varannan vecka': 0.5,
-        '1 gång i veckan': 1.0,
-        '2 gånger i veckan': 2.0,
-        '3 gånger i veckan': 3.0,
-    }
-
-    def to_numeric_freq(s: str):
-        if pd.isna(s):
-            return None
-        key = str(s).strip().lower()
-        return freq_map.get(key)
-
-    results: List[dict] = []
-
-    # Gruppera per Flexplats och jämför max-frekvenser
-    for flexplats, group in df.groupby('Flexplats'):
-        mats = group[group['Fraktion_norm'] == 'Matavfall'].copy()
-        rests = group[group['Fraktion_norm'] == 'Restavfall'].copy()
-
-        # Hoppa över om någon fraktion saknas
-        if mats.empty or rests.empty:
-            continue
-
-        # Konvertera frekvenser till numeriska värden, filtrera bort okända
-        mats['freq_num'] = mats['Hämtfrekvens'].apply(to_numeric_freq)
-        rests['freq_num'] = rests['Hämtfrekvens'].apply(to_numeric_freq)
-
-        mat_vals = sorted([v for v in mats['freq_num'].unique() if v is not None])
-        rest_vals = sorted([v for v in rests['freq_num'].unique() if v is not None])
-
-        # Om vi inte har numeriska värden, hoppa över
-        if not mat_vals or not rest_vals:
-            continue
-
-        # Jämför: skriv ut endast om mat har högre max-frekvens än rest
-        if max(mat_vals) > max(rest_vals):
-            mat_tjanster = sorted(set(mats['Flextjänst'].astype(str)))
-            rest_tjanster = sorted(set(rests['Flextjänst'].astype(str)))
-
-            results.append({
-                "Affärsenhet": group['Affärsenhet'].iat[0],
-                "Kundnummer": group['Kundnummer'].iat[0],
-                "Flexplats": flexplats,
-                "Flexplatsadress": group['Flexplatsadress'].iat[0],
-                "Matavfall hämtfrekvenser": sorted(set(mats['Hämtfrekvens'].astype(str))),
-                "Restavfall hämtfrekvenser": sorted(set(rests['Hämtfrekvens'].astype(str))),
-
-                "Matavfall flextjänster": mat_tjanster,
-                "Restavfall flextjänster": rest_tjanster
-            })
-
-    out_df = pd.DataFrame(results)
-
-    # Skriv resultat till Excel
-    with pd.ExcelWriter(output_path, engine="xlsxwriter") as writer:
-        out_df.to_excel(writer, index=False, sheet_name="Avvikelser")
-        workbook = writer.book
-        worksheet = writer.sheets["Avvikelser"]
-
-        header_fmt = workbook.add_format({"align": "left", "bold": True})
-        for col, value in enumerate(out_df.columns):
-            worksheet.write(0, col, value, header_fmt)
-
-        cell_fmt = workbook.add_format({"align": "left"})
-        worksheet.set_column(0, len(out_df.columns)-1, 25, cell_fmt)
-
-    return len(out_df)
+    },
+    # Normalisera fraktion och kontrollera bara Matavfall/Restavfall
+    include=where(lambda f: _fraktion_norm(f).isin(['Matavfall', 'Restavfall']).to_numpy()),
+    derived={
+        'Fraktion_norm': _fraktion_norm,
+        # Mappa text till numeriskt värde (hämtningar per vecka), en gång per unikt värde
+        'freq_num': lambda f: map_frequencies(f['Hämtfrekvens'], freq_per_week),
+    },
+    rules=[
+        # Gruppera per Flexplats och jämför max-frekvenser
+        GroupRule(
+            'Flexplats',
+            _mat_over_rest,
+            values={
+                "Matavfall hämtfrekvenser": _listed('Hämtfrekvens', mat=True),
+                "Restavfall hämtfrekvenser": _listed('Hämtfrekvens', mat=False),
+                "Matavfall flextjänster": _listed('Flextjänst', mat=True),
+                "Restavfall flextjänster": _listed('Flextjänst', mat=False),
+            },
+        ),
+    ],
+    identity=["Flexplats"],
+)
+
+
+def check_hamtfrekvens(df: pd.DataFrame, snapshot: Optional[str] = None) -> pd.DataFrame:
+
+    unknown = unknown_frequencies(df.loc[RULES.included(df), 'Hämtfrekvens'], freq_per_week)
+    if unknown:
+        logger.warning("Okända hämtfrekvenser: %s", ", ".join(unknown))
+
+    if snapshot:
+        # Återanvänd avvikelser för grupper som är oförändrade sedan förra uppladdningen
+        return evaluate_incremental(snapshot, df, RULES)
+    return evaluate_parallel(df, RULES)
+
+
+def process_hamtfrekvens(input_path: Path, output_path: Path, partitions: Optional[int] = None) -> int:
+    return run_check("hamtfrekvens", RULES, check_hamtfrekvens, input_path, output_path, partitions, col_width=25)
 
 
 # Endpoint för filuppladdning och bearbetning
 @bp.route('/upload/hamtfrekvens', methods=['POST'])
 def hamtfrekvens_mat_rest():
-    if 'file' not in request.files:
-        flash('Ingen fil i anropet')
-        return redirect(url_for('index'))
-
-    file = request.files['file']
-    if file.filename == '':
-        flash('Du måste välja en fil')
-        return redirect(url_for('index'))
-
-    if not allowed_file(file.filename):
-        flash('Endast Excel-filer (.xlsx) tillåtna')
-        return redirect(url_for('index'))
-
-    cleanup_folder()
-
-    input_path, session_id = create_session_paths(file.filename)
-    output_filename = f"avvikelser_hamtfrekvens_{session_id}.xlsx"
-    output_path = UPLOAD_FOLDER / output_filename
-
-    file.save(input_path)
-
-    try:
-        deviations = process_hamtfrekvens(input_path, output_path)
-    except ValueError as e:
-        flash(str(e))
-        return redirect(url_for('index'))
-    except Exception:
-        flash('Fel vid bearbetning av filen')
-        return redirect(url_for('index'))
-
-    if deviations > 0:
-        message = (
-            f"{deviations} flexplatser har avvikelser där matavfallet har tätare hämtning än restavfallet och behöver åtgärd"
-        )
-    else:
-        message = "Inga avvikelser hittades."
-
-    session_key = f"result_{session_id}"
-    session[session_key] = {
-        "deviations": deviations,
-        "output_filename": output_filename,
-        "back": "index",
-        "message": message
-    }
-
-    return redirect(url_for('success', file=session_id))
+    return handle_upload(
+        "hamtfrekvens",
+        process_hamtfrekvens,
+        "avvikelser_hamtfrekvens",
+        "{deviations} flexplatser har avvikelser där matavfallet har tätare hämtning än restavfallet och behöver åtgärd",
+        rules=RULES,
+    )
@@ -0,0 +1,28 @@
+import hmac
+
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from utils import export_store
+
+bp = Blueprint('lookup', __name__)
+
+
+def _authorized() -> bool:
+    # Raderna innehåller kunduppgifter, uppslagning kräver LOOKUP_TOKEN som header eller parameter
+    token = current_app.config.get('LOOKUP_TOKEN')
+    supplied = request.headers.get('X-Lookup-Token') or request.args.get('token')
+    return bool(token) and supplied is not None and hmac.compare_digest(supplied, token)
+
+
+# Endpoint för uppslagning av en nyckel i tidigare uppladdningar, t.ex. /lookup/flexplats/12345
+@bp.route('/lookup/<key>/<path:value>', methods=['GET'])
+def lookup(key, value):
+    if not current_app.config.get('LOOKUP_TOKEN'):
+        abort(404)
+    if not _authorized():
+        abort(403)
+    try:
+        result = export_store.lookup(key, value)
+    except ValueError as e:
+        return jsonify({"fel": str(e)}), 400
+    return jsonify({"nyckel": key, "värde": value, **result})
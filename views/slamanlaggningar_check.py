@@ -1,13 +1,31 @@
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 import re
+import numpy as np
 import pandas as pd
 
-from flask import Blueprint, request, flash, redirect, url_for, session
-from utils.file_utils import allowed_file, create_session_paths, cleanup_folder, UPLOAD_FOLDER
+from flask import Blueprint
+from utils.check_runner import run_check
+from utils.frequency import PARSE_CACHE_SIZE, expected_count, map_frequencies
+from utils.incremental import evaluate_incremental
+from utils.key_index import KeyIndex
+from utils.parallel import evaluate_parallel
+from utils.rules import GroupRule, Predicate, RowRule, RuleFrame, RuleSet, TextRule, blank, differs, missing, where
+from utils.upload_utils import handle_upload
 
 bp = Blueprint('slamanlaggningar_check', __name__)
 
+WEEK_PATTERN = re.compile(r'vecka\s*\d{1,2}')
+
+# Nyckelorden som reglerna letar efter, per kolumn. Körtursplaner och körtursnamn upprepas
+# över många rader, så orden söks i ett svep per kolumn och unikt värde (RuleFrame.keywords)
+KEYWORDS = {
+    'Hämtfrekvens': ('bud', 'vartannat år'),
+    'Ind. körtursplan': ('bud', 'udda år', 'jämna år'),
+    'Körtursnamn': ('bud',),
+}
+
 
 def _norm(s: str) -> str:
     if pd.isna(s):
@@ -15,39 +33,63 @@ def _norm(s: str) -> str:
     return str(s).strip().lower()
 
 
-def expected_count_from_freq(freq: str):
-
-    if pd.isna(freq):
-        return None
-    s = str(freq).strip().lower()
-    if 'vartannat år' in s or 'vartannat-år' in s:
-        return 1
+def _has(col: str, word: str) -> Predicate:
+    return where(lambda f: f.keywords(col, KEYWORDS[col])[word])
 
-    m = re.search(r'(\d+)', s)
-    if m:
-        try:
-            val = int(m.group(1))
-            if 1 <= val <= 12:
-                return val
-        except Exception:
-            return None
-    return None
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def week_tokens(s: str) -> Tuple[str, ...]:
+    # Veckoangivelserna i en körtursplan, tolkade en gång per unik text
+    return tuple(m.strip() for m in WEEK_PATTERN.findall(s.lower()))
 
-def extract_week_tokens(s: str) -> List[str]:
 
-    if pd.isna(s):
+def _week_reasons(ind_kort, kortnamn) -> List[str]:
+    # Veckonummer i Ind. körtursplan måste finnas i Körtursnamn
+    if pd.isna(ind_kort) or str(ind_kort).strip() == "":
         return []
-    s_norm = str(s).lower()
-    matches = re.findall(r'vecka\s*\d{1,2}', s_norm)
-    return [m.strip() for m in matches]
-
-
-def process_slamanlaggningar(input_path: Path, output_path: Path) -> int:
-
-    df = pd.read_excel(input_path)
-
-    required_cols = {
+    kort_norm = _norm(kortnamn)
+    return [
+        f"Ind. körtursplan innehåller '{wk}' men Körtursnamn innehåller inte '{wk}'"
+        for wk in week_tokens(str(ind_kort))
+        if wk not in kort_norm
+    ]
+
+
+def _expected_stats(f: RuleFrame, index: KeyIndex):
+    # Antal förekomster, antal olika förväntade värden och minsta förväntade värde per Flextjänstnr
+    return f.memo("expected", lambda: (
+        index.counts(),
+        index.nunique(f['__expected']),
+        index.min(f['__expected'].to_numpy()),
+    ))
+
+
+def _inconsistent(f: RuleFrame, index: KeyIndex) -> np.ndarray:
+    _, n_expected, _ = _expected_stats(f, index)
+    return n_expected > 1
+
+
+def _wrong_count(f: RuleFrame, index: KeyIndex) -> np.ndarray:
+    counts, n_expected, expected = _expected_stats(f, index)
+    return (n_expected == 1) & (counts != expected)
+
+
+RULES = RuleSet(
+    columns=[
+        "Affärsenhet",
+        "Kundnr",
+        "Flexplatsadress",
+        "Flextjänstnr",
+        "Flexgrupp namn",
+        "Flextyp",
+        "Utförandeområde flextjänst",
+        "Utförandeområde flexplats",
+        "Hämtfrekvens",
+        "Ind. körtursplan",
+        "Körtursnamn",
+        "Orsak",
+    ],
+    required={
         'Affärsenhet',
         'Kundnr',
         'Flexplatsadress',
@@ -59,210 +101,106 @@ def process_slamanlaggningar(input_path: Path, output_path: Path) -> int:
         'Hämtfrekvens',
         'Ind. körtursplan',
         'Körtursnamn'
-    }
-    missing = required_cols - set(df.columns)
-    if missing:
-        raise ValueError(f"Saknar kolumner: {', '.join(missing)}")
-
-    results: List[dict] = []
-    row_level_flags = []  # samla index för rader som redan är avvikande (för att undvika dubbletter)
-
-    for idx, row in df.iterrows():
-        orsaker = []
-
-        ua_tjanst = row.get('Utförandeområde flextjänst')
-        ua_plats = row.get('Utförandeområde flexplats')
-        ind_kort = row.get('Ind. körtursplan')
-        kortnamn = row.get('Körtursnamn')
-        hamt = row.get('Hämtfrekvens')
-        flextyp = row.get('Flextyp')
-
+    },
+    derived={
+        # Förväntat antal per rad, tolkat en gång per unik hämtfrekvens
+        '__expected': lambda f: map_frequencies(f['Hämtfrekvens'], expected_count),
+    },
+    rules=[
         # Om "Utförandeområde flexplats" eller "Utförandeområde flextjänst" saknas
-        if pd.isna(ua_tjanst) or str(ua_tjanst).strip() == "":
-            orsaker.append("Saknar Utförandeområde flextjänst")
-        if pd.isna(ua_plats) or str(ua_plats).strip() == "":
-            orsaker.append("Saknar Utförandeområde flexplats")
+        RowRule(blank('Utförandeområde flextjänst'), "Saknar Utförandeområde flextjänst"),
+        RowRule(blank('Utförandeområde flexplats'), "Saknar Utförandeområde flexplats"),
         # Om båda finns men mismatch
-        if (not pd.isna(ua_tjanst) and not pd.isna(ua_plats)) and (_norm(ua_tjanst) != _norm(ua_plats)):
-            orsaker.append("Utförandeområde flextjänst ≠ Utförandeområde flexplats")
+        RowRule(
+            ~missing('Utförandeområde flextjänst') & ~missing('Utförandeområde flexplats')
+            & differs('Utförandeområde flextjänst', 'Utförandeområde flexplats'),
+            "Utförandeområde flextjänst ≠ Utförandeområde flexplats",
+        ),
 
         # Ind. körtursplan eller Körtursnamn saknas
-        if pd.isna(ind_kort) or str(ind_kort).strip() == "":
-            orsaker.append("Saknar Ind. körtursplan")
-        if pd.isna(kortnamn) or str(kortnamn).strip() == "":
-            orsaker.append("Saknar Körtursnamn")
+        RowRule(blank('Ind. körtursplan'), "Saknar Ind. körtursplan"),
+        RowRule(blank('Körtursnamn'), "Saknar Körtursnamn"),
 
         # Vartannat år, då måste Ind. körtursplan måste innehålla 'udda år' eller 'jämna år'
-        if isinstance(hamt, str) or not pd.isna(hamt):
-            hamt_norm = _norm(hamt)
-            if 'vartannat år' in hamt_norm:
-                if ind_kort is None or not (('udda år' in _norm(ind_kort)) or ('jämna år' in _norm(ind_kort))):
-                    orsaker.append("Hämtfrekvens 'Vartannat år' kräver 'udda år' eller 'jämna år' i Ind. körtursplan")
+        RowRule(
+            _has('Hämtfrekvens', 'vartannat år')
+            & ~(_has('Ind. körtursplan', 'udda år') | _has('Ind. körtursplan', 'jämna år')),
+            "Hämtfrekvens 'Vartannat år' kräver 'udda år' eller 'jämna år' i Ind. körtursplan",
+        ),
 
         # Veckonummer i Ind. körtursplan måste finnas i Körtursnamn
-        if not (pd.isna(ind_kort) or str(ind_kort).strip() == ""):
-            week_tokens = extract_week_tokens(ind_kort)
-            for wk in week_tokens:
-                if wk not in _norm(kortnamn):
-                    orsaker.append(f"Ind. körtursplan innehåller '{wk}' men Körtursnamn innehåller inte '{wk}'")
+        TextRule(['Ind. körtursplan', 'Körtursnamn'], _week_reasons),
 
         # Bud-regeln (gäller åt båda håll)
-        hamt_norm = _norm(hamt)
-        ind_norm = _norm(ind_kort)
-        kort_norm = _norm(kortnamn)
-
-        # Om Hämtfrekvens innehåller 'bud'
-        if 'bud' in hamt_norm:
-            if 'bud' not in ind_norm:
-                orsaker.append("Hämtfrekvens 'Bud' kräver 'Budning' i Ind. körtursplan")
-            if 'bud' not in kort_norm:
-                orsaker.append("Hämtfrekvens 'Bud' kräver 'bud' i Körtursnamn")
-        # Om Ind. körtursplan innehåller budning
-        if 'bud' in ind_norm:
-            if 'bud' not in hamt_norm:
-                orsaker.append("Ind. körtursplan 'Budning' kräver Hämtfrekvens 'Bud'")
-            if 'bud' not in kort_norm:
-                orsaker.append("Ind. körtursplan 'Budning' kräver 'bud' i Körtursnamn")
-        # Om Körtursnamn innehåller bud
-        if 'bud' in kort_norm:
-            if 'bud' not in hamt_norm and 'bud' not in ind_norm:
-                orsaker.append("Körtursnamn innehåller 'bud' men saknar Bud i Hämtfrekvens/Ind. körtursplan")
+        RowRule(
+            _has('Hämtfrekvens', 'bud') & ~_has('Ind. körtursplan', 'bud'),
+            "Hämtfrekvens 'Bud' kräver 'Budning' i Ind. körtursplan",
+        ),
+        RowRule(
+            _has('Hämtfrekvens', 'bud') & ~_has('Körtursnamn', 'bud'),
+            "Hämtfrekvens 'Bud' kräver 'bud' i Körtursnamn",
+        ),
+        RowRule(
+            _has('Ind. körtursplan', 'bud') & ~_has('Hämtfrekvens', 'bud'),
+            "Ind. körtursplan 'Budning' kräver Hämtfrekvens 'Bud'",
+        ),
+        RowRule(
+            _has('Ind. körtursplan', 'bud') & ~_has('Körtursnamn', 'bud'),
+            "Ind. körtursplan 'Budning' kräver 'bud' i Körtursnamn",
+        ),
+        RowRule(
+            _has('Körtursnamn', 'bud') & ~_has('Hämtfrekvens', 'bud') & ~_has('Ind. körtursplan', 'bud'),
+            "Körtursnamn innehåller 'bud' men saknar Bud i Hämtfrekvens/Ind. körtursplan",
+        ),
 
         # Hämtfrekvens får ej vara tom
-        if pd.isna(hamt) or str(hamt).strip() == "":
-            orsaker.append("Saknar Hämtfrekvens")
-
-        if orsaker:
-            row_level_flags.append(idx)
-            results.append({
-                "Affärsenhet": row.get('Affärsenhet'),
-                "Kundnr": row.get('Kundnr'),
-                "Flexplatsadress": row.get('Flexplatsadress'),
-                "Flextjänstnr": row.get('Flextjänstnr'),
-                "Flexgrupp namn": row.get('Flexgrupp namn'),
-                "Flextyp": row.get('Flextyp'),
-                "Utförandeområde flextjänst": ua_tjanst,
-                "Utförandeområde flexplats": ua_plats,
-                "Hämtfrekvens": hamt,
-                "Ind. körtursplan": ind_kort,
-                "Körtursnamn": kortnamn,
-                "Orsak": "; ".join(orsaker)
-            })
-
-    # Räkna förekomster per Flextjänstnr
-    counts = df['Flextjänstnr'].value_counts().to_dict()
-
-    # För varje unikt flextjänstnr, bestäm förväntat antal från raderna i gruppen
-    for flextnr, cnt in counts.items():
-        grp = df[df['Flextjänstnr'] == flextnr]
-        # Hämta frekvensvärden i gruppen (unika)
-        freqs = [f for f in grp['Hämtfrekvens'].dropna().unique()]
-        expected_vals = sorted({expected_count_from_freq(f) for f in freqs if expected_count_from_freq(f) is not None})
-        # Om flera olika förväntade värden finns i samma grupp genererar det avvikelse
-        if len(expected_vals) == 0:
-            continue
-        if len(expected_vals) > 1:
-            rep = grp.iloc[0]
-            results.append({
-                "Affärsenhet": rep.get('Affärsenhet'),
-                "Kundnr": rep.get('Kundnr'),
-                "Flexplatsadress": rep.get('Flexplatsadress'),
-                "Flextjänstnr": flextnr,
-                "Flexgrupp namn": rep.get('Flexgrupp namn'),
-                "Flextyp": rep.get('Flextyp'),
-                "Utförandeområde flextjänst": rep.get('Utförandeområde flextjänst'),
-                "Utförandeområde flexplats": rep.get('Utförandeområde flexplats'),
-                "Hämtfrekvens": ", ".join(map(str, freqs)),
-                "Ind. körtursplan": rep.get('Ind. körtursplan'),
-                "Körtursnamn": rep.get('Körtursnamn'),
-                "Orsak": f"Inkonsekventa Hämtfrekvenser inom flextjänst (ger förväntningar {expected_vals})"
-            })
-            continue
-
-        expected = expected_vals[0]
-        if expected is None:
-            continue
-
-        if cnt != expected:
-            # Fel på antal förekomster av flextjänstnr i relation till förväntat från hämtfrekvens genererar avvikelse
-            rep = grp.iloc[0]
-            results.append({
-                "Affärsenhet": rep.get('Affärsenhet'),
-                "Kundnr": rep.get('Kundnr'),
-                "Flexplatsadress": rep.get('Flexplatsadress'),
-                "Flextjänstnr": flextnr,
-                "Flexgrupp namn": rep.get('Flexgrupp namn'),
-                "Flextyp": rep.get('Flextyp'),
-                "Utförandeområde flextjänst": rep.get('Utförandeområde flextjänst'),
-                "Utförandeområde flexplats": rep.get('Utförandeområde flexplats'),
-                "Hämtfrekvens": rep.get('Hämtfrekvens'),
-                "Ind. körtursplan": rep.get('Ind. körtursplan'),
-                "Körtursnamn": rep.get('Körtursnamn'),
-                "Orsak": f"Flextjänstnr förekommer {cnt} gånger men förväntat {expected} enligt Hämtfrekvens"
-            })
-
-    out_df = pd.DataFrame(results)
-
-    # Skriv resultat till Excel
-    with pd.ExcelWriter(output_path, engine="xlsxwriter") as writer:
-        out_df.to_excel(writer, index=False, sheet_name="Avvikelser")
-        workbook = writer.book
-        worksheet = writer.sheets["Avvikelser"]
-
-        header_fmt = workbook.add_format({"align": "left", "bold": True})
-        for col_idx, value in enumerate(out_df.columns):
-            worksheet.write(0, col_idx, value, header_fmt)
-
-        cell_fmt = workbook.add_format({"align": "left"})
-        worksheet.set_column(0, len(out_df.columns) - 1, 30, cell_fmt)
-
-    return len(out_df)
+        RowRule(blank('Hämtfrekvens'), "Saknar Hämtfrekvens"),
+
+        # Flera olika förväntade värden i samma flextjänst genererar avvikelse
+        GroupRule(
+            'Flextjänstnr',
+            _inconsistent,
+            "Inkonsekventa Hämtfrekvenser inom flextjänst (ger förväntningar {förväntningar})",
+            values={
+                'Hämtfrekvens': lambda f, ix, g: [
+                    ", ".join(map(str, vals)) for vals in ix.distinct(f['Hämtfrekvens'], g)],
+                'förväntningar': lambda f, ix, g: [
+                    sorted(int(v) for v in vals) for vals in ix.distinct(f['__expected'], g)],
+            },
+        ),
+        # Fel på antal förekomster av flextjänstnr i relation till förväntat från hämtfrekvens genererar avvikelse
+        GroupRule(
+            'Flextjänstnr',
+            _wrong_count,
+            "Flextjänstnr förekommer {antal} gånger men förväntat {förväntat} enligt Hämtfrekvens",
+            values={
+                'antal': lambda f, ix, g: _expected_stats(f, ix)[0][g],
+                'förväntat': lambda f, ix, g: _expected_stats(f, ix)[2][g].astype(int),
+            },
+        ),
+    ],
+    identity=["Flextjänstnr"],
+)
+
+
+def check_slamanlaggningar(df: pd.DataFrame, snapshot: Optional[str] = None) -> pd.DataFrame:
+    if snapshot:
+        # Återanvänd avvikelser för grupper som är oförändrade sedan förra uppladdningen
+        return evaluate_incremental(snapshot, df, RULES)
+    return evaluate_parallel(df, RULES)
+
+
+def process_slamanlaggningar(input_path: Path, output_path: Path, partitions: Optional[int] = None) -> int:
+    return run_check("slamanlaggningar", RULES, check_slamanlaggningar, input_path, output_path, partitions)
 
 
 # Endpoint för filuppladdning och bearbetning
 @bp.route('/upload/slamanlaggningar_check', methods=['POST'])
 def slamanlaggningar_upload():
-    if 'file' not in request.files:
-        flash('Ingen fil i anropet')
-        return redirect(url_for('index'))
-
-    file = request.files['file']
-    if file.filename == '':
-        flash('Du måste välja en fil')
-        return redirect(url_for('index'))
-
-    if not allowed_file(file.filename):
-        flash('Endast Excel-filer (.xlsx) tillåtna')
-        return redirect(url_for('index'))
-
-    cleanup_folder()
-
-    input_path, session_id = create_session_paths(file.filename)
-    output_filename = f"avvikelser_slamanlaggningar_{session_id}.xlsx"
-    output_path = UPLOAD_FOLDER / output_filename
-
-    file.save(input_path)
-
-    try:
-        deviations = process_slamanlaggningar(input_path, output_path)
-    except ValueError as e:
-        flash(str(e))
-        return redirect(url_for('index'))
-    except Exception:
-        flash('Fel vid bearbetning av filen')
-        return redirect(url_for('index'))
-
-    if deviations > 0:
-        message = f"{deviations} anläggningar har avvikelser som behöver hanteras"
-    else:
-        message = "Inga avvikelser hittades."
-
-    session_key = f"result_{session_id}"
-    session[session_key] = {
-        "deviations": deviations,
-        "output_filename": output_filename,
-        "back": "index",
-        "message": message
-    }
-
-    return redirect(url_for('success', file=session_id))
+    return handle_upload(
+        "slamanlaggningar",
+        process_slamanlaggningar,
+        "avvikelser_slamanlaggningar",
+        "{deviations} anläggningar har avvikelser som behöver hanteras",
+        rules=RULES,
+    )
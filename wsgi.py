@@ -1,4 +1,13 @@
+import gc
+
 from app import app
+from utils.warmup import warm_up
+
+# uWSGI laddar appen i mastern och forkar sedan workers (lazy-apps är avstängt i app.ini).
+# Allt som laddas här delas mellan workerna, och gc.freeze flyttar det till den permanenta
+# generationen så att skräpsamlingen i workerna inte rör objekten och kopierar sidorna
+warm_up(app)
+gc.freeze()
 
 if __name__ == "__main__":
     app.run()